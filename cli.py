@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
+import sys
+from typing import Optional
 
 from sqlmodel import Session
 
 from src import model
 from src.config import settings
-from src.depends import engine
+from src.database import get_engine, run_migrations
 from src.utils import generate_secret, hash_password
 
 parser = argparse.ArgumentParser()
 sub_parser = parser.add_subparsers(dest='command')
 
 create_database_parser = sub_parser.add_parser('create-database')
+sub_parser.add_parser('migrate')
 
 create_user_parser = sub_parser.add_parser('create-user')
 create_user_parser.add_argument('name', type=str)
@@ -20,14 +24,30 @@ create_user_parser.add_argument('email', type=str)
 create_user_parser.add_argument('password', type=str)
 
 sub_parser.add_parser('purge')
+sub_parser.add_parser('backup')
+sub_parser.add_parser('tier-blobs')
+sub_parser.add_parser('split-database')
+
+coalesce_parser = sub_parser.add_parser('set-coalesce-window')
+coalesce_parser.add_argument('vault_id', type=int)
+coalesce_parser.add_argument('seconds', type=int, help='0 to disable')
+
+export_vault_parser = sub_parser.add_parser('export-vault')
+export_vault_parser.add_argument('vault_id', type=int)
+export_vault_parser.add_argument('--version', type=int, help='export the state at this record id')
+export_vault_parser.add_argument('--output', type=str, help='output tar file, defaults to stdout')
+
+import_vault_parser = sub_parser.add_parser('import-vault')
+import_vault_parser.add_argument('vault_id', type=int)
+import_vault_parser.add_argument('input', type=str, help='tar file created by export-vault, - for stdin')
 
 args = parser.parse_args()
 
 def create_database():
-  model.create_db_and_tables(engine)
+  model.create_db_and_tables(get_engine())
 
 def create_user(name: str, email: str, password: str):
-  with Session(engine) as db:
+  with Session(get_engine()) as db:
     salt = generate_secret()
     password_hash = hash_password(password, salt)
     user = model.User(name=name, email=email, password=password_hash, salt=salt)
@@ -42,15 +62,81 @@ def purge():
   from src.purger import Purger
   Purger(config=settings.purge).purge()
 
+def backup():
+  from src.backup import Backup
+  Backup(config=settings.backup).backup()
+
+def tier_blobs():
+  from src.tiering import Tiering
+  Tiering(config=settings.tiering).tier()
+
+def split_database():
+  from src.shard import split_database
+
+  if not settings.database.shard_vaults:
+    print('Set database__shard_vaults=true before splitting the database.')
+    sys.exit(1)
+
+  split_database(get_engine())
+
+def set_coalesce_window(vault_id: int, seconds: int):
+  from src.cache import invalidate_vault
+
+  with Session(get_engine()) as db:
+    vault = db.get(model.Vault, vault_id)
+    if not vault:
+      print(f'Vault {vault_id} not found.')
+      return
+
+    vault.coalesce_window = seconds
+    db.add(vault)
+    db.commit()
+
+    invalidate_vault(db, vault_id)
+
+  print(f'Coalesce window of vault {vault_id} set to {seconds}s.')
+
+def export_vault(vault_id: int, version: Optional[int], output: Optional[str]):
+  from src.archive import export_vault
+
+  with open(output, 'wb') if output else os.fdopen(sys.stdout.fileno(), 'wb', closefd=False) as f:
+    for chunk in export_vault(vault_id, version):
+      f.write(chunk)
+
+def import_vault(vault_id: int, input: str):
+  from src.archive import import_vault
+
+  with open(input, 'rb') if input != '-' else os.fdopen(sys.stdin.fileno(), 'rb', closefd=False) as f:
+    count = import_vault(vault_id, f)
+
+  print(f'Imported {count} records into vault {vault_id}.')
+
 def main():
+  if args.command:
+    run_migrations()
+
   match args.command:
     # used for development
     case 'create-database':
       create_database()
+    case 'migrate':
+      print('Database is up to date.')
     case 'create-user':
       create_user(args.name, args.email, args.password)
     case 'purge':
       purge()
+    case 'backup':
+      backup()
+    case 'tier-blobs':
+      tier_blobs()
+    case 'split-database':
+      split_database()
+    case 'set-coalesce-window':
+      set_coalesce_window(args.vault_id, args.seconds)
+    case 'export-vault':
+      export_vault(args.vault_id, args.version, args.output)
+    case 'import-vault':
+      import_vault(args.vault_id, args.input)
     case _:
       parser.print_help()
 
@@ -0,0 +1,147 @@
+import json
+import os
+import tarfile
+import tempfile
+import time
+from typing import IO, Iterator, Optional
+
+from sqlmodel import Session
+
+from . import dao, model, storage
+from .database import get_session
+
+META_NAME = 'vault.json'
+BLOB_PREFIX = 'blobs/'
+READ_SIZE = 1024 * 1024
+SPOOL_SIZE = 4 * 1024 * 1024
+
+def _header(name: str, size: int):
+  info = tarfile.TarInfo(name)
+  info.size = size
+  info.mtime = int(time.time())
+
+  return info.tobuf(tarfile.PAX_FORMAT)
+
+def _padding(size: int):
+  return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+def record_to_meta(record):
+  return {
+    'path': record.path,
+    'relatedpath': record.relatedpath,
+    'hash': record.hash,
+    'folder': record.folder,
+    'size': record.size,
+    'device': record.device,
+    'ctime': record.ctime,
+    'mtime': record.mtime,
+  }
+
+def _spool_meta(db: Session, vault_id: int, version: int, out: IO[bytes]):
+  # same document as json.dumps() of the whole dict, written row by row
+  out.write(b'{"vault_id": %d, "version": %d, "records": [' % (vault_id, version))
+
+  for i, record in enumerate(dao.DocumentRecord.get_head(db, vault_id, version)):
+    if i:
+      out.write(b', ')
+    out.write(json.dumps(record_to_meta(record)).encode())
+
+  out.write(b']}')
+
+def _spool_hashes(db: Session, vault_id: int, version: int, out: IO[bytes]):
+  for hash in dao.DocumentRecord.get_head_hashes(db, vault_id, version):
+    out.write(hash.encode() + b'\n')
+
+def export_vault(vault_id: int, version: Optional[int] = None) -> Iterator[bytes]:
+  # metadata is read in one short transaction, blobs are addressed by
+  # hash and those released by coalescing are only purged hours later,
+  # so streaming them afterwards is still consistent
+  with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as meta, \
+      tempfile.SpooledTemporaryFile(SPOOL_SIZE) as hashes:
+    with get_session() as db:
+      version = dao.DocumentRecord.get_version(db, vault_id, version)
+      _spool_meta(db, vault_id, version, meta)
+      _spool_hashes(db, vault_id, version, hashes)
+
+    size = meta.tell()
+    meta.seek(0)
+    yield _header(META_NAME, size)
+
+    while chunk := meta.read(READ_SIZE):
+      yield chunk
+
+    yield _padding(size)
+
+    hashes.seek(0)
+    for line in hashes:
+      hash = line.rstrip().decode()
+
+      try:
+        f = storage.get_file_object(vault_id, hash)
+      except FileNotFoundError:
+        # the response has started, all that is left is to end it early
+        raise RuntimeError(f'Blob {hash} of vault {vault_id} is gone, export aborted')
+
+      with f:
+        size = os.fstat(f.fileno()).st_size
+        yield _header(BLOB_PREFIX + hash, size)
+
+        while chunk := f.read(READ_SIZE):
+          yield chunk
+
+        yield _padding(size)
+
+  # end of archive marker
+  yield b'\0' * tarfile.BLOCKSIZE * 2
+
+def import_vault(vault_id: int, fileobj: IO[bytes], device: str = 'import'):
+  meta = None
+
+  with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+    for member in tar:
+      src = tar.extractfile(member)
+      if not src:
+        continue
+
+      if member.name == META_NAME:
+        meta = json.load(src)
+      elif member.name.startswith(BLOB_PREFIX):
+        hash = member.name[len(BLOB_PREFIX):]
+        if not hash.isalnum():
+          raise ValueError(f'Invalid blob name: {member.name}')
+
+        writer = storage.BlobWriter(vault_id, hash, member.size)
+        try:
+          while chunk := src.read(READ_SIZE):
+            writer.write(chunk)
+
+          if writer.written != member.size:
+            raise ValueError(f'Truncated blob in archive: {member.name}')
+
+          writer.commit()
+        except BaseException:
+          writer.abort()
+          raise
+
+  if meta is None:
+    raise ValueError(f'{META_NAME} not found in archive')
+
+  with get_session() as db:
+    dao.route(db, vault_id)
+
+    for item in meta['records']:
+      db.add(model.DocumentRecord(
+        vault_id=vault_id,
+        path=item['path'],
+        relatedpath=item['relatedpath'],
+        hash=item['hash'],
+        folder=item['folder'],
+        size=item['size'],
+        device=device,
+        ctime=item['ctime'],
+        mtime=item['mtime'],
+      ))
+
+    db.commit()
+
+  return len(meta['records'])
@@ -0,0 +1,210 @@
+import asyncio
+import datetime
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from typing import Optional
+
+from . import shard, storage
+from .config import BackupSettings, settings
+from .database import get_engine
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'data.db'
+BLOBS_NAME = 'blobs'
+COLD_NAME = 'cold'
+
+class _Restarted(Exception):
+  pass
+
+class Backup:
+  config: BackupSettings
+  task: Optional[asyncio.Task]
+
+  def __init__(self, config: BackupSettings):
+    self.config = config
+
+  async def start(self):
+    self.task = asyncio.create_task(self._loop())
+
+  async def stop(self):
+    self.task.cancel()
+
+    logger.info('Waiting for backup task to stop...')
+    await asyncio.wait_for(self.task, None)
+
+  async def _loop(self):
+    time_delta = datetime.timedelta(hours=self.config.interval)
+    interval = time_delta.total_seconds()
+
+    while True:
+      logger.info('Next backup in %s', time_delta)
+      try:
+        await asyncio.sleep(interval)
+      except asyncio.CancelledError:
+        logger.debug('Backup task cancelled')
+        return
+
+      logger.info('Backing up...')
+
+      try:
+        await asyncio.to_thread(self.backup)
+      except Exception:
+        logger.exception('Backup failed')
+
+  def backup(self):
+    start = time.monotonic()
+
+    # microseconds keep backups taken within the same second apart
+    name = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    target = os.path.join(self.config.dir, name)
+    tmp_target = target + '.tmp'
+    previous = self._list_backups()[-1:]
+
+    os.makedirs(tmp_target)
+
+    try:
+      stalled = 0.0
+      engine = get_engine()
+      if engine.dialect.name == 'sqlite':
+        stalled += self._backup_db(engine.url.database, os.path.join(tmp_target, DB_NAME))
+      else:
+        logger.warning('Database backup is only supported on SQLite, use the database tools instead')
+
+      for vault_name in self._list_shards():
+        vault_dir = os.path.join(tmp_target, BLOBS_NAME, vault_name)
+        os.makedirs(vault_dir, exist_ok=True)
+        stalled += self._backup_db(
+          os.path.join(storage.PREFIX, vault_name, shard.SHARD_NAME),
+          os.path.join(vault_dir, shard.SHARD_NAME),
+        )
+
+      added, linked = self._backup_blobs(
+        os.path.join(tmp_target, BLOBS_NAME),
+        os.path.join(self.config.dir, previous[0], BLOBS_NAME) if previous else None,
+      )
+
+      if os.path.isdir(settings.tiering.dir):
+        cold_added, cold_linked = self._backup_blobs(
+          os.path.join(tmp_target, COLD_NAME),
+          os.path.join(self.config.dir, previous[0], COLD_NAME) if previous else None,
+          settings.tiering.dir,
+        )
+        added += cold_added
+        linked += cold_linked
+
+      os.rename(tmp_target, target)
+    except BaseException:
+      shutil.rmtree(tmp_target, ignore_errors=True)
+      raise
+
+    self._rotate()
+
+    result = {
+      'path': target,
+      'duration': time.monotonic() - start,
+      'stalled': stalled,
+      'blobs_added': added,
+      'blobs_linked': linked,
+    }
+
+    logger.info(
+      'Backup created at %s in %.2fs, writers stalled %.3fs, blobs added: %d, linked: %d',
+      target, result['duration'], stalled, added, linked,
+    )
+
+    return result
+
+  def _list_backups(self):
+    if not os.path.isdir(self.config.dir):
+      return []
+
+    return sorted(
+      name for name in os.listdir(self.config.dir)
+      if not name.endswith('.tmp')
+    )
+
+  def _rotate(self):
+    backups = self._list_backups()
+
+    for name in backups[:-self.config.keep]:
+      logger.debug('Removing old backup: %s', name)
+      shutil.rmtree(os.path.join(self.config.dir, name))
+
+  def _list_shards(self):
+    if not os.path.isdir(storage.PREFIX):
+      return []
+
+    return [
+      name for name in os.listdir(storage.PREFIX)
+      if os.path.exists(os.path.join(storage.PREFIX, name, shard.SHARD_NAME))
+    ]
+
+  def _backup_db(self, src_path: str, path: str) -> float:
+    stalled = 0.0
+    last_step = time.monotonic()
+    last_remaining = None
+
+    def progress(status, remaining, total):
+      nonlocal stalled, last_step, last_remaining
+
+      now = time.monotonic()
+      stalled += max(0, now - last_step - self.config.sleep)
+      last_step = now
+
+      # the backup starts over when another connection writes in between
+      if last_remaining is not None and remaining > last_remaining:
+        raise _Restarted()
+      last_remaining = remaining
+
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(path)
+
+    try:
+      try:
+        src.backup(dst, pages=self.config.pages, progress=progress, sleep=self.config.sleep)
+      except _Restarted:
+        logger.info('Database changed during backup, copying in one step')
+
+        # in WAL mode a single step only holds a read snapshot,
+        # so writers are still not blocked
+        step_start = time.monotonic()
+        src.backup(dst)
+        stalled += time.monotonic() - step_start
+    finally:
+      dst.close()
+      src.close()
+
+    return stalled
+
+  def _backup_blobs(self, target: str, previous: Optional[str], source: str = storage.PREFIX):
+    added = 0
+    linked = 0
+
+    for dir_path, _, files in os.walk(source):
+      rel_dir = os.path.relpath(dir_path, source)
+      # blobs are stored as <vault>/<aa>/<bb>/<rest>
+      if len(rel_dir.split(os.sep)) != 3:
+        continue
+
+      os.makedirs(os.path.join(target, rel_dir), exist_ok=True)
+
+      for name in files:
+        rel_path = os.path.join(rel_dir, name)
+        dst = os.path.join(target, rel_path)
+
+        if previous:
+          try:
+            os.link(os.path.join(previous, rel_path), dst)
+            linked += 1
+            continue
+          except FileNotFoundError:
+            pass
+
+        shutil.copy2(os.path.join(dir_path, name), dst)
+        added += 1
+
+    return added, linked
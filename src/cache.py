@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from . import dao
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'vault_access'
+
+class VaultAccessCache:
+  def __init__(self, ttl: int, max_vaults: int):
+    self.ttl = ttl
+    self.max_vaults = max_vaults
+
+    # vault_id -> user_id -> (allowed, expires)
+    self._access: OrderedDict[int, dict[int, tuple[bool, float]]] = OrderedDict()
+    # vault_id -> ((key_hash, coalesce_window), expires)
+    self._vaults: OrderedDict[int, tuple[Optional[tuple[str, int]], float]] = OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+
+  def check_access(self, db: Session, vault_id: int, user_id: int) -> bool:
+    now = time.monotonic()
+    users = self._access.get(vault_id)
+
+    entry = users.get(user_id) if users else None
+    if entry and entry[1] > now:
+      self.hits += 1
+      self._access.move_to_end(vault_id)
+      return entry[0]
+
+    self.misses += 1
+    allowed = dao.Vault.check_access(db, vault_id, user_id, True)
+
+    # unknown vaults are only remembered by the vault entry
+    if users is None and self._get_vault(db, vault_id):
+      users = self._put(self._access, vault_id, {})
+    if users is not None:
+      users[user_id] = (allowed, now + self.ttl)
+
+    return allowed
+
+  def _get_vault(self, db: Session, vault_id: int):
+    now = time.monotonic()
+
+    entry = self._vaults.get(vault_id)
+    if entry and entry[1] > now:
+      self.hits += 1
+      self._vaults.move_to_end(vault_id)
+      return entry[0]
+
+    self.misses += 1
+    vault = dao.Vault.get(db, vault_id)
+    info = (vault.key_hash, vault.coalesce_window) if vault else None
+    self._put(self._vaults, vault_id, (info, now + self.ttl))
+
+    return info
+
+  def _put(self, entries: OrderedDict, vault_id: int, value):
+    entries[vault_id] = value
+    entries.move_to_end(vault_id)
+
+    while len(entries) > self.max_vaults:
+      entries.popitem(last=False)
+
+    return value
+
+  def get_key_hash(self, db: Session, vault_id: int) -> Optional[str]:
+    info = self._get_vault(db, vault_id)
+
+    return info[0] if info else None
+
+  def get_coalesce_window(self, db: Session, vault_id: int) -> int:
+    info = self._get_vault(db, vault_id)
+
+    return info[1] if info else 0
+
+  def invalidate(self, vault_id: int):
+    self._access.pop(vault_id, None)
+    self._vaults.pop(vault_id, None)
+
+  def stats(self):
+    return {
+      'vaults': len(self._access),
+      'hits': self.hits,
+      'misses': self.misses,
+    }
+
+class BlobCache:
+  def __init__(self, memory: int, max_size: int):
+    self.memory = memory
+    self.max_size = max_size
+
+    self._blobs: OrderedDict[tuple[int, str], bytes] = OrderedDict()
+    self._size = 0
+
+    self.hits = 0
+    self.misses = 0
+
+  def accepts(self, size: int):
+    return 0 < size <= min(self.max_size, self.memory)
+
+  def get(self, vault_id: int, hash: str) -> Optional[bytes]:
+    key = (vault_id, hash)
+
+    data = self._blobs.get(key)
+    if data is None:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    self._blobs.move_to_end(key)
+
+    return data
+
+  def put(self, vault_id: int, hash: str, data: bytes):
+    if not self.accepts(len(data)):
+      return
+
+    key = (vault_id, hash)
+    self.discard(vault_id, hash)
+
+    self._blobs[key] = data
+    self._size += len(data)
+
+    while self._size > self.memory:
+      _, evicted = self._blobs.popitem(last=False)
+      self._size -= len(evicted)
+
+  def discard(self, vault_id: int, hash: str):
+    data = self._blobs.pop((vault_id, hash), None)
+    if data is not None:
+      self._size -= len(data)
+
+  def stats(self):
+    total = self.hits + self.misses
+
+    return {
+      'entries': len(self._blobs),
+      'size': self._size,
+      'memory': self.memory,
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_ratio': self.hits / total if total else 0,
+    }
+
+vault_access = VaultAccessCache(settings.cache.access_ttl, settings.cache.access_vaults)
+blob_cache = BlobCache(settings.cache.blob_memory, settings.cache.blob_max_size)
+
+def invalidate_vault(db: Session, vault_id: int):
+  vault_access.invalidate(vault_id)
+
+  # other workers are told through the database when it can broadcast,
+  # otherwise their entries expire after the ttl
+  if db.get_bind().dialect.name == 'postgresql':
+    db.execute(text('SELECT pg_notify(:channel, :payload)'), {
+      'channel': NOTIFY_CHANNEL,
+      'payload': str(vault_id),
+    })
+    db.commit()
+
+class InvalidationListener:
+  def __init__(self, engine: Engine):
+    self.engine = engine
+    self.conn = None
+
+  async def start(self):
+    self.conn = self.engine.raw_connection()
+    dbapi_conn = self.conn.connection
+    dbapi_conn.autocommit = True
+
+    with dbapi_conn.cursor() as cursor:
+      cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(dbapi_conn.fileno(), self._on_notify)
+
+  async def stop(self):
+    if not self.conn:
+      return
+
+    loop = asyncio.get_running_loop()
+    loop.remove_reader(self.conn.connection.fileno())
+
+    self.conn.invalidate()
+    self.conn = None
+
+  def _on_notify(self):
+    dbapi_conn = self.conn.connection
+    dbapi_conn.poll()
+
+    while dbapi_conn.notifies:
+      notify = dbapi_conn.notifies.pop(0)
+      logger.debug('vault access invalidated, vault_id: %s', notify.payload)
+      vault_access.invalidate(int(notify.payload))
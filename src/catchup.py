@@ -0,0 +1,140 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from typing import Callable
+
+Payload = tuple[int, list[str]]
+
+class CatchupCache:
+  # shares catch-up queries of concurrent reconnects, keyed by
+  # (vault_id, version, initial), and keeps the encoded result briefly
+  def __init__(self, ttl: float, concurrency: int, jitter: float, memory: int):
+    self.ttl = ttl
+    self.memory = memory
+    self.concurrency = concurrency
+    self.jitter = jitter
+
+    self._inflight: dict[int, dict[tuple[int, bool], asyncio.Task]] = {}
+    # loads keep running when their callers go away
+    self._tasks: set[asyncio.Task] = set()
+    # vault_id -> (version, initial) -> (payload, size, expires),
+    # least recently used vaults first
+    self._cached: OrderedDict[int, dict[tuple[int, bool], tuple[Payload, int, float]]] = OrderedDict()
+    self._size = 0
+    self._generations: dict[int, int] = {}
+    self._semaphore = asyncio.Semaphore(concurrency)
+
+    self.queries = 0
+    self.shared = 0
+    self.hits = 0
+
+  async def get(
+    self,
+    vault_id: int,
+    version: int,
+    initial: bool,
+    load: Callable[[], Payload],
+  ) -> Payload:
+    key = (version, initial)
+
+    cached = self._cached.get(vault_id)
+    entry = cached.get(key) if cached else None
+    if entry:
+      if entry[2] > time.monotonic():
+        self.hits += 1
+        self._cached.move_to_end(vault_id)
+        return entry[0]
+
+      self._drop(vault_id, key)
+
+    inflight = self._inflight.setdefault(vault_id, {})
+    task = inflight.get(key)
+    if task:
+      self.shared += 1
+    else:
+      # not owned by this caller, so cancelling it, like when its
+      # device drops, does not fail the others
+      task = asyncio.create_task(self._load(vault_id, key, load))
+      inflight[key] = task
+      self._tasks.add(task)
+      task.add_done_callback(self._done)
+
+    return await asyncio.shield(task)
+
+  async def _load(self, vault_id: int, key: tuple[int, bool], load: Callable[[], Payload]):
+    generation = self._generations.get(vault_id, 0)
+
+    if self._semaphore.locked():
+      # spread a reconnect storm instead of queueing it all at once
+      await asyncio.sleep(random.uniform(0, self.jitter))
+
+    async with self._semaphore:
+      self.queries += 1
+      payload = await asyncio.to_thread(load)
+
+    if self._generations.get(vault_id, 0) == generation:
+      self._put(vault_id, key, payload)
+
+    return payload
+
+  def _done(self, task: asyncio.Task):
+    self._tasks.discard(task)
+
+    for vault_id, inflight in list(self._inflight.items()):
+      for key, t in list(inflight.items()):
+        if t is task:
+          del inflight[key]
+
+      if not inflight:
+        del self._inflight[vault_id]
+
+    if not task.cancelled():
+      # mark it retrieved, when no one is waiting for it anymore
+      task.exception()
+
+  def _put(self, vault_id: int, key: tuple[int, bool], payload: Payload):
+    size = sum(len(text) for text in payload[1])
+    if size > self.memory:
+      return
+
+    now = time.monotonic()
+    for cached_vault_id, cached in list(self._cached.items()):
+      for expired in [k for k, entry in cached.items() if entry[2] <= now]:
+        self._drop(cached_vault_id, expired)
+
+    self._drop(vault_id, key)
+    self._cached.setdefault(vault_id, {})[key] = (payload, size, now + self.ttl)
+    self._cached.move_to_end(vault_id)
+    self._size += size
+
+    while self._size > self.memory:
+      _, evicted = self._cached.popitem(last=False)
+      self._size -= sum(entry[1] for entry in evicted.values())
+
+  def _drop(self, vault_id: int, key: tuple[int, bool]):
+    cached = self._cached.get(vault_id)
+    if not cached or key not in cached:
+      return
+
+    self._size -= cached.pop(key)[1]
+    if not cached:
+      del self._cached[vault_id]
+
+  def invalidate(self, vault_id: int):
+    self._generations[vault_id] = self._generations.get(vault_id, 0) + 1
+
+    cached = self._cached.pop(vault_id, None)
+    if cached:
+      self._size -= sum(entry[1] for entry in cached.values())
+    # waiters keep their result, new callers start a fresh query
+    self._inflight.pop(vault_id, None)
+
+  def stats(self):
+    return {
+      'queries': self.queries,
+      'shared': self.shared,
+      'hits': self.hits,
+      'cached_vaults': len(self._cached),
+      'size': self._size,
+    }
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from sqlalchemy.engine import Engine
+
+from . import shard, stats
+from .config import CheckpointSettings
+from .database import get_engine
+
+logger = logging.getLogger(__name__)
+
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER = 24
+
+class _WalState:
+  # frame counts from the last checkpoint, the WAL file never shrinks
+  # before a TRUNCATE and writers reuse it from the start, so its size
+  # on disk tells neither how much is left to copy nor whether writes go on
+  __slots__ = ('frames', 'salts', 'backlog', 'peak', 'changed_at', 'mode', 'duration', 'busy')
+
+  def __init__(self, peak: int):
+    # frames in the WAL, and those not copied back to the database yet
+    self.frames: Optional[int] = None
+    self.salts: Optional[bytes] = None
+    self.backlog = 0
+    # frames the WAL file holds on disk
+    self.peak = peak
+    self.changed_at = time.monotonic()
+    self.mode: Optional[str] = None
+    self.duration = 0.0
+    self.busy = 0
+
+class Checkpointer:
+  config: CheckpointSettings
+  task: Optional[asyncio.Task]
+
+  def __init__(self, config: CheckpointSettings):
+    self.config = config
+
+    self.states: dict[str, _WalState] = {}
+    self.counts = {
+      'PASSIVE': 0,
+      'RESTART': 0,
+      'TRUNCATE': 0,
+    }
+
+  async def start(self):
+    stats.register('checkpointer', self.stats)
+    self.task = asyncio.create_task(self._loop())
+
+  async def stop(self):
+    stats.unregister('checkpointer')
+    self.task.cancel()
+
+    logger.info('Waiting for checkpointer task to stop...')
+    await asyncio.wait_for(self.task, None)
+
+  async def _loop(self):
+    while True:
+      try:
+        await asyncio.sleep(self.config.interval)
+      except asyncio.CancelledError:
+        logger.debug('Checkpointer task cancelled')
+        return
+
+      try:
+        await asyncio.to_thread(self.run)
+      except Exception:
+        logger.exception('Checkpoint failed')
+
+  def _engines(self) -> list[Engine]:
+    return [get_engine(), *shard.engines()]
+
+  def run(self):
+    for db_engine in self._engines():
+      self._checkpoint(db_engine)
+
+  def _choose_mode(self, state: _WalState, frame_size: int):
+    quiet = time.monotonic() - state.changed_at >= self.config.quiet_period
+
+    if state.peak * frame_size >= self.config.truncate_size and quiet:
+      return 'TRUNCATE'
+
+    # PASSIVE checkpoints do not keep up, readers hold old frames
+    if state.backlog * frame_size >= self.config.restart_size:
+      return 'RESTART'
+
+    return 'PASSIVE'
+
+  def _checkpoint(self, db_engine: Engine):
+    db_path = db_engine.url.database
+    if not db_path:
+      return
+
+    with db_engine.connect() as conn:
+      frame_size = conn.exec_driver_sql('PRAGMA page_size').scalar_one() + WAL_FRAME_HEADER
+
+      state = self.states.get(db_path)
+      if not state:
+        wal_path = db_path + '-wal'
+        size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        state = self.states[db_path] = _WalState(size // frame_size)
+
+      mode = self._choose_mode(state, frame_size)
+
+      start = time.monotonic()
+      # the connection goes back to the pool, keep its own timeout there
+      timeout = conn.exec_driver_sql('PRAGMA busy_timeout').scalar_one()
+      conn.exec_driver_sql(f'PRAGMA busy_timeout={self.config.busy_timeout}')
+      try:
+        busy, log, checkpointed = conn.exec_driver_sql(
+          f'PRAGMA wal_checkpoint({mode})'
+        ).one()
+      finally:
+        conn.exec_driver_sql(f'PRAGMA busy_timeout={int(timeout)}')
+
+    state.mode = mode
+    state.duration = time.monotonic() - start
+    state.busy += busy
+    self.counts[mode] += 1
+
+    # -1 when the database is not in WAL mode
+    log = max(log, 0)
+    checkpointed = max(checkpointed, 0)
+
+    # writers restart a checkpointed WAL with new salts, so the same
+    # frame count may still mean new writes
+    salts = self._read_salts(db_path + '-wal')
+    if log != state.frames or salts != state.salts:
+      state.changed_at = time.monotonic()
+
+    state.frames = log
+    state.salts = salts
+    state.backlog = log - checkpointed
+    state.peak = max(state.peak, log)
+
+    if mode == 'TRUNCATE' and not busy:
+      state.peak = 0
+
+    logger.debug(
+      'Checkpoint %s on %s, frames: %d/%d, busy: %d, took %.3fs',
+      mode, db_path, checkpointed, log, busy, state.duration,
+    )
+
+  @staticmethod
+  def _read_salts(wal_path: str) -> Optional[bytes]:
+    try:
+      with open(wal_path, 'rb') as f:
+        header = f.read(WAL_HEADER_SIZE)
+    except FileNotFoundError:
+      return None
+
+    return header[16:24]
+
+  def stats(self):
+    return {
+      'counts': self.counts,
+      'databases': {
+        path: {
+          'wal_frames': state.frames,
+          'backlog_frames': state.backlog,
+          'file_frames': state.peak,
+          'last_mode': state.mode,
+          'last_duration': state.duration,
+          'busy': state.busy,
+        }
+        for path, state in self.states.items()
+      },
+    }
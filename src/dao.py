@@ -1,9 +1,59 @@
 # mypy: ignore-errors
-from typing import Iterator, Optional
+import datetime
+from typing import Iterable, Iterator, Optional
+from sqlalchemy.engine import Row
 from sqlmodel import Session, col, func, select, not_, or_
 
 from . import model
 
+# keep IN lists below the bound variable limit of SQLite
+IN_BATCH_SIZE = 500
+
+# columns read by the hot paths as plain rows, skipping the ORM objects
+MSG_COLUMNS = (
+  model.DocumentRecord.id,
+  model.DocumentRecord.path,
+  model.DocumentRecord.hash,
+  model.DocumentRecord.folder,
+  model.DocumentRecord.deleted,
+  model.DocumentRecord.ctime,
+  model.DocumentRecord.mtime,
+  model.DocumentRecord.size,
+)
+HISTORY_COLUMNS = (
+  model.DocumentRecord.id,
+  model.DocumentRecord.path,
+  model.DocumentRecord.relatedpath,
+  model.DocumentRecord.folder,
+  model.DocumentRecord.device,
+  model.DocumentRecord.size,
+  model.DocumentRecord.deleted,
+  model.DocumentRecord.created_at,
+)
+EXPORT_COLUMNS = (
+  model.DocumentRecord.path,
+  model.DocumentRecord.relatedpath,
+  model.DocumentRecord.hash,
+  model.DocumentRecord.folder,
+  model.DocumentRecord.size,
+  model.DocumentRecord.device,
+  model.DocumentRecord.ctime,
+  model.DocumentRecord.mtime,
+)
+STREAM_BATCH_SIZE = 1000
+
+def route(db: Session, vault_id: int):
+  # vault data may live in a per-vault database, see shard.RoutingSession
+  current = db.info.get('vault_id')
+  if current == vault_id:
+    return
+
+  if current is not None:
+    # pending objects belong to the previous vault
+    db.flush()
+
+  db.info['vault_id'] = vault_id
+
 class Vault:
   @staticmethod
   def _get_query(
@@ -28,7 +78,7 @@ class Vault:
           model.Vault.owner_id == user_id,
           model.VaultShare.user_id == user_id,
         )
-      ).distinct(model.Vault.id)
+      ).distinct()
     else:
       query = query.where(
         model.Vault.owner_id == user_id,
@@ -66,6 +116,8 @@ class Vault:
 
   @staticmethod
   def get_size(db: Session, vault_id: int):
+    route(db, vault_id)
+
     size = db.exec(select(func.sum(model.DocumentRecord.size)).where(
       model.DocumentRecord.vault_id == vault_id,
     )).one()
@@ -74,6 +126,8 @@ class Vault:
     
   @staticmethod
   def get_hash_count(db: Session, vault_id: int, hash: str):
+    route(db, vault_id)
+
     count = db.exec(select(func.count(model.DocumentRecord.id)).where(
       model.DocumentRecord.vault_id == vault_id,
       model.DocumentRecord.hash == hash,
@@ -81,9 +135,26 @@ class Vault:
 
     return count
 
+  @staticmethod
+  def get_existing_hashes(db: Session, vault_id: int, hashes: Iterable[str]) -> set[str]:
+    route(db, vault_id)
+
+    hashes = list(set(hashes))
+    existing: set[str] = set()
+
+    for i in range(0, len(hashes), IN_BATCH_SIZE):
+      existing.update(db.exec(select(model.DocumentRecord.hash).where(
+        model.DocumentRecord.vault_id == vault_id,
+        col(model.DocumentRecord.hash).in_(hashes[i:i + IN_BATCH_SIZE]),
+      ).distinct()).all())
+
+    return existing
+
 class DocumentRecord:
   @staticmethod
   def get(db: Session, vault_id: int, user_id: int):
+    route(db, vault_id)
+
     record = db.exec(select(model.DocumentRecord).where(
       model.DocumentRecord.vault_id == vault_id,
       model.DocumentRecord.id == user_id,
@@ -92,23 +163,66 @@ class DocumentRecord:
     return record
   
   @staticmethod
-  def get_deleted(db: Session, vault_id: int) -> Iterator[model.DocumentRecord]:
-    record_tuples = db.exec(
-      select(
-        model.DocumentRecord,
-        func.max(model.DocumentRecord.id),
-      ).where(
+  def _latest_ids(vault_id: int, last: int = 0, until: Optional[int] = None):
+    # id of the latest record of each path, portable replacement of
+    # selecting bare columns next to max() in a GROUP BY
+    query = select(
+      func.max(model.DocumentRecord.id),
+    ).where(
+      model.DocumentRecord.vault_id == vault_id,
+    ).group_by(
+      model.DocumentRecord.path,
+    )
+
+    if last:
+      query = query.where(model.DocumentRecord.id > last)
+
+    if until is not None:
+      query = query.where(model.DocumentRecord.id <= until)
+
+    return query.scalar_subquery()
+
+  @staticmethod
+  def get_many(db: Session, vault_id: int, ids: list[int]) -> dict[int, model.DocumentRecord]:
+    route(db, vault_id)
+
+    records = {}
+    for i in range(0, len(ids), IN_BATCH_SIZE):
+      for record in db.exec(select(model.DocumentRecord).where(
         model.DocumentRecord.vault_id == vault_id,
-      ).group_by(
-        model.DocumentRecord.path,
-      ).having(
+        col(model.DocumentRecord.id).in_(ids[i:i + IN_BATCH_SIZE]),
+      )):
+        records[record.id] = record
+
+    return records
+
+  @staticmethod
+  def get_latest(db: Session, vault_id: int, path: str):
+    route(db, vault_id)
+
+    record = db.exec(select(model.DocumentRecord).where(
+      model.DocumentRecord.vault_id == vault_id,
+      model.DocumentRecord.path == path,
+    ).order_by(
+      col(model.DocumentRecord.id).desc()
+    ).limit(1)).one_or_none()
+
+    return record
+
+  @classmethod
+  def get_deleted(cls, db: Session, vault_id: int) -> Iterator[Row]:
+    route(db, vault_id)
+
+    records = db.exec(
+      select(*HISTORY_COLUMNS).where(
+        col(model.DocumentRecord.id).in_(cls._latest_ids(vault_id)),
         model.DocumentRecord.deleted,
       ).order_by(
         col(model.DocumentRecord.id).asc()
       )
     )
 
-    return map(lambda record: record[0], record_tuples)
+    return records
   
   @staticmethod
   def get_history(
@@ -116,8 +230,10 @@ class DocumentRecord:
     vault_id: int,
     path: str,
     last: int,
-  ) -> Iterator[model.DocumentRecord]:
-    query = select(model.DocumentRecord).where(
+  ) -> Iterator[Row]:
+    route(db, vault_id)
+
+    query = select(*HISTORY_COLUMNS).where(
       model.DocumentRecord.vault_id == vault_id,
       model.DocumentRecord.path == path,
     )
@@ -132,51 +248,125 @@ class DocumentRecord:
 
     return records
   
-  @staticmethod
+  @classmethod
   def get_updates(
+    cls,
     db: Session,
     vault_id: int,
     last: int,
     initial: bool,
-  ) -> tuple[int, Iterator[model.DocumentRecord]]:
-    max_id = db.exec(select(func.max(model.DocumentRecord.id)).where(
-      model.DocumentRecord.vault_id == vault_id,
-    )).one() or 0
+  ) -> tuple[int, Iterator[Row]]:
+    max_id = cls.get_max_id(db, vault_id)
 
     if last == max_id:
       return max_id, []
     
     assert last < max_id
 
-    query = select(
-      model.DocumentRecord,
-      func.max(model.DocumentRecord.id),
-    ).where(
-      model.DocumentRecord.vault_id == vault_id,
-      model.DocumentRecord.id > last,
-    ).group_by(
-      model.DocumentRecord.path,
+    query = select(*MSG_COLUMNS).where(
+      col(model.DocumentRecord.id).in_(cls._latest_ids(vault_id, last)),
     )
 
     if initial:
-      query = query.having(not_(model.DocumentRecord.deleted))
+      query = query.where(not_(model.DocumentRecord.deleted))
     
     query = query.order_by(
       model.DocumentRecord.id
     )
     
-    return max_id, map(lambda r: r[0], db.exec(query))
+    return max_id, db.exec(query)
+
+  @classmethod
+  def get_cold_hashes(cls, db: Session, vault_id: int, before: datetime.datetime) -> set[str]:
+    route(db, vault_id)
+
+    old = db.exec(select(model.DocumentRecord.hash).where(
+      model.DocumentRecord.vault_id == vault_id,
+      model.DocumentRecord.created_at < before,
+      model.DocumentRecord.size > 0,
+    ).distinct())
+
+    hot = db.exec(select(model.DocumentRecord.hash).where(
+      model.DocumentRecord.vault_id == vault_id,
+      or_(
+        col(model.DocumentRecord.id).in_(cls._latest_ids(vault_id)),
+        model.DocumentRecord.created_at >= before,
+      ),
+    ).distinct())
+
+    return set(old) - set(hot)
+
+  @staticmethod
+  def get_max_id(db: Session, vault_id: int) -> int:
+    route(db, vault_id)
+
+    return db.exec(select(func.max(model.DocumentRecord.id)).where(
+      model.DocumentRecord.vault_id == vault_id,
+    )).one() or 0
+
+  @staticmethod
+  def count_since(db: Session, vault_id: int, last: int) -> int:
+    route(db, vault_id)
+
+    return db.exec(select(func.count(model.DocumentRecord.id)).where(
+      model.DocumentRecord.vault_id == vault_id,
+      model.DocumentRecord.id > last,
+    )).one()
+
+  @staticmethod
+  def get_version(db: Session, vault_id: int, until: Optional[int] = None) -> int:
+    route(db, vault_id)
+
+    query = select(func.max(model.DocumentRecord.id)).where(
+      model.DocumentRecord.vault_id == vault_id,
+    )
+    if until is not None:
+      query = query.where(model.DocumentRecord.id <= until)
+
+    return db.exec(query).one() or 0
+
+  @classmethod
+  def get_head(cls, db: Session, vault_id: int, until: int):
+    route(db, vault_id)
+
+    # rows are streamed, the caller reads them before the session ends
+    return db.exec(select(*EXPORT_COLUMNS).where(
+      col(model.DocumentRecord.id).in_(cls._latest_ids(vault_id, until=until)),
+      not_(model.DocumentRecord.deleted),
+    ).order_by(
+      model.DocumentRecord.id
+    ).execution_options(yield_per=STREAM_BATCH_SIZE))
+
+  @classmethod
+  def get_head_hashes(cls, db: Session, vault_id: int, until: int):
+    route(db, vault_id)
+
+    return db.exec(select(model.DocumentRecord.hash).where(
+      col(model.DocumentRecord.id).in_(cls._latest_ids(vault_id, until=until)),
+      not_(model.DocumentRecord.deleted),
+      not_(model.DocumentRecord.folder),
+      model.DocumentRecord.size > 0,
+    ).distinct().order_by(
+      model.DocumentRecord.hash
+    ).execution_options(yield_per=STREAM_BATCH_SIZE))
   
 class PendingFile:
   @staticmethod
   def get_or_create(db: Session, vault_id: int, hash: str, type: model.PendingFileType):
+    route(db, vault_id)
+
     record = db.exec(select(model.PendingFile).where(
       model.PendingFile.vault_id == vault_id,
       model.PendingFile.hash == hash,
-      model.PendingFile.type == type,
     )).one_or_none()
 
-    if not record:
+    if record and record.type != type:
+      # a blob released by coalescing is uploaded again
+      record.type = type
+      record.created_at = datetime.datetime.now()
+      db.add(record)
+      db.commit()
+    elif not record:
       record = model.PendingFile(
         vault_id=vault_id,
         hash=hash,
@@ -186,4 +376,25 @@ class PendingFile:
       db.add(record)
       db.commit()
 
-    return record
\ No newline at end of file
+    return record
+
+  @staticmethod
+  def release(db: Session, vault_id: int, hash: str):
+    # the blob is removed by the purger later, as reads may still use it,
+    # committed by the caller along with the superseding record
+    route(db, vault_id)
+
+    record = db.exec(select(model.PendingFile).where(
+      model.PendingFile.vault_id == vault_id,
+      model.PendingFile.hash == hash,
+    )).one_or_none()
+
+    if record:
+      # already released, or being uploaded again
+      return
+
+    db.add(model.PendingFile(
+      vault_id=vault_id,
+      hash=hash,
+      type=model.PendingFileType.DELETE,
+    ))
\ No newline at end of file
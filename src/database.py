@@ -0,0 +1,68 @@
+import fcntl
+import logging
+import os
+import threading
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from . import model
+from .config import settings
+from .shard import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+# held while migrating, by server workers and cli invocations on this host
+MIGRATION_LOCK = 'data/migration.lock'
+# key of the PostgreSQL advisory lock, for nodes sharing the database
+MIGRATION_LOCK_KEY = 0x6f6273796e63
+
+_engine: Optional[Engine] = None
+_migrated = False
+_lock = threading.Lock()
+
+def get_engine() -> Engine:
+  global _engine
+
+  if _engine:
+    return _engine
+
+  with _lock:
+    if not _engine:
+      _engine = model.get_engine(
+        settings.database.url,
+        settings.echo,
+        pool_size=settings.database.pool_size,
+        max_overflow=settings.database.max_overflow,
+        pool_timeout=settings.database.pool_timeout,
+      )
+
+  return _engine
+
+def get_session():
+  return RoutingSession(get_engine())
+
+def run_migrations():
+  global _migrated
+
+  if _migrated:
+    return
+
+  from .migration import run_migrations
+
+  os.makedirs(os.path.dirname(MIGRATION_LOCK), exist_ok=True)
+
+  with open(MIGRATION_LOCK, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      engine = get_engine()
+      with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql':
+          conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+        run_migrations(conn)
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+  _migrated = True
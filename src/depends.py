@@ -1,29 +1,13 @@
 from typing import Annotated
 
 from fastapi import Body, Depends, HTTPException
-from sqlalchemy import event
 from sqlmodel import Session, select
 
-from .config import settings
-from .model import DB_URL, User, UserToken, get_engine
-
-engine = get_engine(DB_URL, settings.echo)
-
-@event.listens_for(engine, 'connect')
-def conn_wal_mode(conn, _):
-  conn.execute('PRAGMA journal_mode=WAL')
-  conn.execute('PRAGMA synchronous=NORMAL')
-
-def db_migrations():
-  from .migration import run_migrations
-
-  with engine.begin() as conn:
-    run_migrations(conn)
-
-db_migrations()
+from .database import get_session
+from .model import User, UserToken
 
 def db_session():
-  with Session(engine) as session:
+  with get_session() as session:
     yield session
 
 DbSession = Annotated[Session, Depends(db_session)]
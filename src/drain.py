@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import random
+import signal
+import time
+from typing import Optional
+
+from .config import DrainSettings, settings
+
+logger = logging.getLogger(__name__)
+
+# close code telling clients to reconnect
+SERVICE_RESTART = 1012
+
+class Drainer:
+  # stops taking sync connections, closes the open ones once idle
+  # and exits, so another instance sharing the port takes over
+  config: DrainSettings
+  task: Optional[asyncio.Task]
+
+  def __init__(self, config: DrainSettings):
+    self.config = config
+    self.task = None
+    self.draining = False
+    self.signal = False
+    # connections providing `busy` and `close(code)`
+    self.conns: set = set()
+
+  async def start(self):
+    if not self.config.signal:
+      return
+
+    try:
+      asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, self.drain)
+      self.signal = True
+    except RuntimeError:
+      # signals are only delivered to the main thread
+      logger.warning('Drain signal not available outside of the main thread')
+
+  async def stop(self):
+    if self.signal:
+      asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR2)
+      self.signal = False
+
+    if self.task:
+      self.task.cancel()
+
+      logger.info('Waiting for drain task to stop...')
+      await asyncio.wait([self.task])
+
+  def drain(self):
+    if self.draining:
+      return
+
+    logger.info('Draining %d connections', len(self.conns))
+    self.draining = True
+    self.task = asyncio.create_task(self._drain())
+
+  async def _drain(self):
+    deadline = time.monotonic() + self.config.deadline
+    closing: dict = {}
+
+    try:
+      while self.conns and time.monotonic() < deadline:
+        for conn in self.conns:
+          if conn not in closing and not conn.busy:
+            delay = random.uniform(0, self.config.stagger)
+            closing[conn] = asyncio.create_task(self._close(conn, delay, closing))
+
+        await asyncio.sleep(0.5)
+    finally:
+      for task in closing.values():
+        task.cancel()
+
+    if self.conns:
+      logger.warning('Closing %d busy connections', len(self.conns))
+
+      await asyncio.gather(
+        *(self._close(conn) for conn in list(self.conns)),
+      )
+
+    logger.info('Drained, exiting')
+    os.kill(os.getpid(), signal.SIGTERM)
+
+  async def _close(self, conn, delay: float = 0, closing: Optional[dict] = None):
+    await asyncio.sleep(delay)
+
+    if closing is not None and conn.busy:
+      # picked up a new op meanwhile, wait for it again
+      del closing[conn]
+      return
+
+    try:
+      await conn.close(SERVICE_RESTART)
+    except Exception:
+      logger.debug('close failed', exc_info=True)
+
+drainer = Drainer(settings.drain)
@@ -45,11 +45,17 @@ def _from_2(op: Operations):
     sa.UniqueConstraint('vault_id', 'hash'),
   )
 
+def _from_3(op: Operations):
+  op.add_column('vault', sa.Column(
+    'coalesce_window', sa.Integer(), nullable=False, server_default='0'
+  ))
+
 
 _ACTIONS: list[Callable[[Operations], Optional[int]]] = [
   _create_database,
   _from_1,
   _from_2,
+  _from_3,
 ]
 
 LATEST_VERSION = len(_ACTIONS)
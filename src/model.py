@@ -2,6 +2,9 @@ import enum
 from datetime import datetime
 from typing import Optional
 
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from sqlmodel import Field, Relationship, SQLModel, UniqueConstraint, create_engine
 
 
@@ -34,6 +37,9 @@ class Vault(SQLModel, table=True):
   key_hash: str
   salt: str
   deleted: bool = Field(default=False)
+  # in seconds, successive pushes of a path from the same device within
+  # it replace the previous record instead of adding history, 0 disables
+  coalesce_window: int = Field(default=0)
   created_at: datetime = Field(default_factory=datetime.now)
 
   owner: User = Relationship()
@@ -70,13 +76,35 @@ class PendingFile(SQLModel, table=True):
     UniqueConstraint('vault_id', 'hash'),
   )
 
-def get_engine(db_url: str, echo: bool = False):
-  return create_engine(db_url, echo=echo, connect_args={
-    'check_same_thread': False
-  })
+def conn_wal_mode(conn, _):
+  conn.execute('PRAGMA journal_mode=WAL')
+  conn.execute('PRAGMA synchronous=NORMAL')
+
+def get_engine(
+  db_url: str,
+  echo: bool = False,
+  pool_size: int = 5,
+  max_overflow: int = 10,
+  pool_timeout: float = 30,
+):
+  connect_args = {}
+  if make_url(db_url).get_backend_name() == 'sqlite':
+    connect_args['check_same_thread'] = False
+
+  engine = create_engine(
+    db_url,
+    echo=echo,
+    poolclass=QueuePool,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=pool_timeout,
+    connect_args=connect_args,
+  )
+
+  if engine.dialect.name == 'sqlite':
+    event.listen(engine, 'connect', conn_wal_mode)
+
+  return engine
 
 def create_db_and_tables(engine):
   SQLModel.metadata.create_all(engine)
-
-DB_PATH = 'data/data.db'
-DB_URL = 'sqlite:///' + DB_PATH
@@ -7,24 +7,19 @@ from typing import Optional
 
 from sqlmodel import Session, select
 
-from . import model
-from .config import PurgeSettings
-from .depends import engine
+from . import dao, model, shard
+from .config import PurgeSettings, settings
+from .database import get_engine, get_session
 from .storage import get_vault_dir
 from src import storage
 
 logger = logging.getLogger(__name__)
 
-def check_sql_dialect():
-  assert engine.dialect.name == 'sqlite', 'Purging is only supported on SQLite for now'
-
 class Purger:
   config: PurgeSettings
   task: Optional[asyncio.Task]
 
   def __init__(self, config: PurgeSettings):
-    check_sql_dialect()
-
     self.config = config
 
   async def start(self):
@@ -53,33 +48,81 @@ class Purger:
       await asyncio.to_thread(self.purge)
 
   def purge(self):
-    with Session(engine) as db:
-      db.execute('BEGIN IMMEDIATE')
+    with get_session() as db:
+      if get_engine().dialect.name == 'sqlite':
+        db.execute('BEGIN IMMEDIATE')
+
       self._purge_deleted_vaults(db)
       self._purge_pending_upload_files(db)
+      self._purge_released_files(db)
     
-      db.execute('VACUUM')
+    self._vacuum()
+
+  def _vacuum(self):
+    # VACUUM can not run inside a transaction
+    with get_engine().connect() as conn:
+      conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+      conn.exec_driver_sql('VACUUM')
   
   def _purge_pending_upload_files(self, db: Session):
     time_delta = datetime.timedelta(days=self.config.pending_age)
     created_before = datetime.datetime.now() - time_delta
-    pending_files = db.exec(select(model.PendingFile)
-      .where(
-        model.PendingFile.created_at <= created_before,
-        model.PendingFile.type == model.PendingFileType.UPLOAD,
-      )
+    query = select(model.PendingFile).where(
+      model.PendingFile.created_at <= created_before,
+      model.PendingFile.type == model.PendingFileType.UPLOAD,
     )
 
-    for pending_file in pending_files:
-      path = storage.get_file_path(pending_file.vault_id, pending_file.hash)
-      if os.path.exists(path):
-        os.remove(path)
-      
-      db.delete(pending_file)
-    
-    logger.info('Purged %d pending upload files', len(db.deleted))
-    db.commit()
+    count = 0
+    for vault_id in self._vault_ids(db):
+      if vault_id is not None:
+        dao.route(db, vault_id)
+
+      for pending_file in db.exec(query):
+        path = storage.get_file_path(pending_file.vault_id, pending_file.hash)
+        if os.path.exists(path):
+          os.remove(path)
+        
+        db.delete(pending_file)
+        count += 1
+
+      db.commit()
+
+    logger.info('Purged %d pending upload files', count)
   
+  def _purge_released_files(self, db: Session):
+    time_delta = datetime.timedelta(hours=self.config.released_age)
+    created_before = datetime.datetime.now() - time_delta
+    query = select(model.PendingFile).where(
+      model.PendingFile.created_at <= created_before,
+      model.PendingFile.type == model.PendingFileType.DELETE,
+    )
+
+    count = 0
+    for vault_id in self._vault_ids(db):
+      if vault_id is not None:
+        dao.route(db, vault_id)
+
+      for pending_file in db.exec(query).all():
+        # referenced again by a later push or restore
+        if not dao.Vault.get_hash_count(db, pending_file.vault_id, pending_file.hash):
+          storage.remove_file(pending_file.vault_id, pending_file.hash)
+          count += 1
+
+        db.delete(pending_file)
+
+      db.commit()
+
+    logger.info('Purged %d released files', count)
+
+  def _vault_ids(self, db: Session) -> list[Optional[int]]:
+    if not shard.is_enabled():
+      return [None]
+
+    # committed per vault, so only one vault database is used at a time,
+    # and vaults without one have nothing to purge
+    vault_ids = db.exec(select(model.Vault.id)).all()
+    return [vault_id for vault_id in vault_ids if vault_id is not None and shard.exists(vault_id)]
+
   def _purge_deleted_vaults(self, db: Session):
     vaults = db.exec(select(model.Vault).where(model.Vault.deleted))
     for vault in vaults:
@@ -88,9 +131,15 @@ class Purger:
   def _purge_deleted_vault(self, db: Session, vault: model.Vault):
     logger.debug('Purging deleted vault, id: %d, name: %s', vault.id, vault.name)
 
-    db.query(model.PendingFile).filter(
-      model.PendingFile.vault_id == vault.id
-    ).delete()
+    assert vault.id is not None
+    sharded = shard.is_enabled()
+    if sharded:
+      # the vault database is removed along with the vault directory
+      shard.dispose_shard(vault.id)
+    else:
+      db.query(model.PendingFile).filter(
+        model.PendingFile.vault_id == vault.id
+      ).delete()
 
     db.query(model.VaultShare).filter(
       model.VaultShare.vault_id == vault.id
@@ -98,17 +147,21 @@ class Purger:
 
     logger.debug('Vault shares deleted')
 
-    assert vault.id is not None
     dir_path = get_vault_dir(vault.id)
     shutil.rmtree(dir_path)
 
+    cold_dir = os.path.join(settings.tiering.dir, str(vault.id))
+    if os.path.isdir(cold_dir):
+      shutil.rmtree(cold_dir)
+
     logger.debug('Vault directory deleted')
 
-    db.query(model.DocumentRecord).filter(
-      model.DocumentRecord.vault_id == vault.id
-    ).delete()
+    if not sharded:
+      db.query(model.DocumentRecord).filter(
+        model.DocumentRecord.vault_id == vault.id
+      ).delete()
 
-    logger.debug('Document records deleted')
+      logger.debug('Document records deleted')
 
     db.delete(vault)
     logger.info('Purged vault, id: %d, name: %s', vault.id, vault.name)
@@ -1,19 +1,31 @@
 import asyncio
+import base64
 import json
 import logging
 import math
 import secrets
+import time
+from contextvars import ContextVar
+from collections import OrderedDict, deque
 from contextlib import closing
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import Optional, cast
 
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import PlainTextResponse
+from fastapi.websockets import WebSocketState
+from pydantic import BaseModel
+from sqlalchemy.engine import Row
 from sqlmodel import Session
 
-from .. import dao, model, storage
+from .. import dao, model, stats, storage
+from ..cache import blob_cache, vault_access
+from ..catchup import CatchupCache
 from ..config import settings
-from ..depends import DbSession, get_user_token
+from ..database import get_session
+from ..depends import get_user_token
+from ..drain import SERVICE_RESTART, drainer
+from ..transfer import BufferPool, Deflater, TokenBucket, TransferScheduler
 from ..utils import datetime_to_ts
 
 logger = logging.getLogger(__name__)
@@ -23,18 +35,95 @@ router = APIRouter()
 SYNC_SIZE_LIMIT = 10 * 1024 * 1024 * 1024
 CHUNK_SIZE = 2 * 1024 * 1024
 
+# optional protocol features, requested by the client in init
+FEATURE_PUSH_BATCH = 'push-batch'
+FEATURE_INLINE = 'inline'
+FEATURE_CONCURRENT = 'concurrent'
+FEATURE_DEFLATE = 'deflate'
+REDIRECTS_LIMIT = 1024
+GOING_AWAY = 1001
+
+# ops answered right away with the concurrent feature, even while
+# a transfer is in progress, all others keep their order
+CONTROL_OPS = {'ping', 'size', 'deleted', 'history'}
+
+# rid of the request being handled, echoed in its responses
+request_id: ContextVar[Optional[int]] = ContextVar('request_id', default=None)
+
+buffer_pool = BufferPool(CHUNK_SIZE, settings.transfer.buffers, settings.transfer.idle_buffers)
+scheduler = TransferScheduler(
+  concurrency=settings.transfer.concurrency,
+  small_size=settings.transfer.small_size,
+  small_slots=settings.transfer.small_slots,
+  conn_rate=settings.transfer.conn_rate,
+  user_rate=settings.transfer.user_rate,
+)
+
+stats.register('buffer_pool', buffer_pool.stats)
+stats.register('scheduler', scheduler.stats)
+stats.register('vault_access', vault_access.stats)
+stats.register('blob_cache', blob_cache.stats)
+
+blob_writes = storage.FsyncBatcher(settings.transfer.fsync_delay)
+stats.register('blob_writes', blob_writes.stats)
+
+catchup = CatchupCache(
+  ttl=settings.cache.catchup_ttl,
+  concurrency=settings.cache.catchup_concurrency,
+  jitter=settings.cache.catchup_jitter,
+  memory=settings.cache.catchup_memory,
+)
+stats.register('catchup', catchup.stats)
+
+recent_stats = {
+  'hits': 0,
+  'misses': 0,
+}
+stats.register('recent_records', lambda: recent_stats)
+
+coalesce_stats = {
+  'rows': 0,
+  'bytes': 0,
+}
+stats.register('coalesce', lambda: coalesce_stats)
+
+compress_stats = {
+  'frames': 0,
+  'bytes_in': 0,
+  'bytes_out': 0,
+  'cpu_time': 0.0,
+}
+stats.register('compress', lambda: {
+  **compress_stats,
+  'bytes_saved': compress_stats['bytes_in'] - compress_stats['bytes_out'],
+})
+
+# blobs being uploaded by this process, set when the upload is done,
+# other workers only rely on the atomic rename of BlobWriter
+uploads: dict[tuple[int, str], asyncio.Event] = {}
+upload_stats = {
+  'waits': 0,
+  'skipped': 0,
+}
+stats.register('uploads', lambda: {**upload_stats, 'active': len(uploads)})
+
 @router.get('')
 def index():
   return PlainTextResponse('Sync server')
 
 @router.websocket('')
-async def websocket(ws: WebSocket, db: DbSession):
+async def websocket(ws: WebSocket):
   await ws.accept()
 
+  if drainer.draining:
+    # a close before accept rejects the handshake with a plain 403
+    await ws.close(SERVICE_RESTART)
+    return
+
   conn = None
 
   try:
-    conn = await UserSyncConn.auth(ws, db)
+    conn = await UserSyncConn.auth(ws)
     await conn.loop()
   except WebSocketDisconnect:
     pass
@@ -48,13 +137,25 @@ async def websocket(ws: WebSocket, db: DbSession):
     if conn:
       conn.disconnect()
 
+class DrainRequest(BaseModel):
+  token: str
+
+if settings.drain.token:
+  @router.post('/drain')
+  async def drain(req: DrainRequest):
+    if not secrets.compare_digest(req.token, settings.drain.token):
+      raise HTTPException(403)
+
+    drainer.drain()
+
+    return {}
+
 if settings.debug:
   @router.get('/status')
   def status():
     vaults = [
       {
         'id': vault.vault_id,
-        'size': vault.size,
         'conn_devices': [conn.device for conn in vault.conns],
       }
       for vault in vault_channels.values()
@@ -62,12 +163,31 @@ if settings.debug:
     return {
       'vaults': vaults,
       'vaults_count': len(vaults),
+      **stats.collect(),
     }
 
+class FrameTooLarge(Exception):
+  def __init__(self, text: str):
+    super().__init__('Frame too large')
+    self.text = text
+
+async def receive_frame(ws: WebSocket, text_limit: int):
+  message = await ws.receive()
+  if message['type'] == 'websocket.disconnect':
+    raise WebSocketDisconnect(message.get('code', 1000))
+
+  if message.get('bytes') is not None:
+    if len(message['bytes']) > CHUNK_SIZE:
+      raise Exception('Frame too large')
+  elif len(message['text']) > text_limit:
+    raise FrameTooLarge(message['text'])
+
+  return message
+
 def size_to_pieces(size: int):
   return math.ceil(size / CHUNK_SIZE)
 
-def record_to_msg(record: model.DocumentRecord):
+def record_to_msg(record: model.DocumentRecord | Row):
   msg = {
     'uid': record.id,
     'path': record.path,
@@ -83,7 +203,25 @@ def record_to_msg(record: model.DocumentRecord):
   
   return msg
 
-def record_to_history(record: model.DocumentRecord):
+def encode_msg(msg: dict):
+  # same encoding as WebSocket.send_json
+  return json.dumps(msg, separators=(',', ':'))
+
+def load_updates(vault_id: int, version: int, initial: bool):
+  with get_session() as db:
+    [lastest, records] = dao.DocumentRecord.get_updates(
+      db, vault_id, version, initial,
+    )
+
+    payload = []
+    for record in records:
+      msg = record_to_msg(record)
+      msg['op'] = 'push'
+      payload.append(encode_msg(msg))
+
+  return lastest, payload
+
+def record_to_history(record: model.DocumentRecord | Row):
   return {
     'uid': record.id,
     'path': record.path,
@@ -95,42 +233,87 @@ def record_to_history(record: model.DocumentRecord):
     'ts': datetime_to_ts(record.created_at),
   }
 
-class UserVaultChannel:
-  def __init__(self, db: Session, vault_id: int):
-    self.vault_id = vault_id
+class RecentRecords:
+  # encoded push messages of the latest records of a vault,
+  # complete for every record after `since`
+  def __init__(self, since: int, size: int):
+    self.since = since
+    self.size = size
 
-    self.conns: list['UserSyncConn'] = []
+    # (uid, path, deleted, encoded msg)
+    self.entries: deque[tuple[int, str, bool, str]] = deque()
 
-    self.vault = self._get_vault(db, vault_id)
-  
-  @staticmethod
-  def _get_vault(db: Session, vault_id: int):
-    vault = dao.Vault.get(db, vault_id)
+  def append(self, msg: dict):
+    if not self.size:
+      return
 
-    if not vault:
-      raise Exception('Vault not found')
+    self.entries.append((msg['uid'], msg['path'], msg['deleted'], encode_msg(dict(msg, op='push'))))
 
-    return vault
+    while len(self.entries) > self.size:
+      self.since = self.entries.popleft()[0]
+
+  def remove(self, uid: int):
+    for entry in self.entries:
+      if entry[0] == uid:
+        self.entries.remove(entry)
+        break
+
+  def get(self, db: Session, vault_id: int, version: int, initial: bool):
+    if not self.size or version < self.since:
+      return None
+
+    entries = [entry for entry in self.entries if entry[0] > version]
+    lastest = entries[-1][0] if entries else version
+    if lastest < version:
+      return None
+
+    # records from other workers or the cli never pass through here
+    if dao.DocumentRecord.count_since(db, vault_id, version) != len(entries):
+      return None
+
+    latest_paths: dict[str, tuple[int, str, bool, str]] = {}
+    for entry in entries:
+      latest_paths.pop(entry[1], None)
+      latest_paths[entry[1]] = entry
+
+    payload = [
+      text for _, _, deleted, text in latest_paths.values()
+      if not (initial and deleted)
+    ]
+
+    return lastest, payload
+
+class UserVaultChannel:
+  def __init__(self, vault_id: int, since: int):
+    self.vault_id = vault_id
+    self.recent = RecentRecords(since, settings.cache.recent_records)
+
+    self.conns: list['UserSyncConn'] = []
+    # uid of a coalesced record -> uid of the record replacing it,
+    # for pulls racing with the replacement
+    self.redirects: OrderedDict[int, int] = OrderedDict()
   
   @staticmethod
   def join(
     conn: 'UserSyncConn',
+    db: Session,
     user_id: int,
     vault_id: str,
     keyhash: str,
   ):
     _vault_id: int = int(vault_id)
-    vault_state = vault_channels.get(_vault_id) 
-    if not vault_state:
-      vault_state = UserVaultChannel(conn.db, _vault_id)
-      vault_channels[_vault_id] = vault_state
-    
-    vault = vault_state.vault
-    if not dao.Vault.check_access(conn.db, _vault_id, user_id, True):
+    if not vault_access.check_access(db, _vault_id, user_id):
       raise Exception('Auth failed')
 
-    if not secrets.compare_digest(vault.key_hash, keyhash):
+    key_hash = vault_access.get_key_hash(db, _vault_id)
+    if not key_hash or not secrets.compare_digest(key_hash, keyhash):
       raise Exception('Invalid password')
+
+    vault_state = vault_channels.get(_vault_id) 
+    if not vault_state:
+      since = dao.DocumentRecord.get_max_id(db, _vault_id)
+      vault_state = UserVaultChannel(_vault_id, since)
+      vault_channels[_vault_id] = vault_state
     
     logger.debug('vault join, vault_id: %d, device: %s', _vault_id, conn.device)
     vault_state.conns.append(conn)
@@ -144,28 +327,152 @@ class UserVaultChannel:
     if len(self.conns) == 0:
       del vault_channels[self.vault_id]
   
-  async def push(self, record: model.DocumentRecord):
+  @staticmethod
+  def _inlines(c: 'UserSyncConn', origin: Optional['UserSyncConn']):
+    # the pushing device has the content already
+    return FEATURE_INLINE in c.features and c is not origin
+
+  async def _read_inline(self, record: model.DocumentRecord, origin: Optional['UserSyncConn']):
+    if record.folder or record.deleted or not 0 < record.size <= settings.transfer.inline_size:
+      return None
+
+    if not any(self._inlines(c, origin) for c in self.conns):
+      return None
+
+    # just uploaded blobs are usually still cached
+    data = blob_cache.get(self.vault_id, record.hash)
+    if data is None:
+      data = await asyncio.to_thread(self._read_blob, record.hash)
+
+    return base64.b64encode(data).decode()
+
+  def _read_blob(self, hash: str) -> bytes:
+    with closing(storage.get_file_object(self.vault_id, hash)) as f:
+      return f.read()
+
+  async def push(self, record: model.DocumentRecord, origin: Optional['UserSyncConn'] = None):
+    catchup.invalidate(self.vault_id)
+
     msg = record_to_msg(record)
+    self.recent.append(msg)
     msg['op'] = 'push'
 
+    inline_msg = None
+    if data := await self._read_inline(record, origin):
+      inline_msg = dict(msg, data=data)
+
     for c in self.conns:
-      await c.send(msg)
+      if inline_msg and self._inlines(c, origin):
+        await c.notify(inline_msg)
+      else:
+        await c.notify(msg)
+
+  async def push_batch(self, msgs: list[dict]):
+    catchup.invalidate(self.vault_id)
+
+    for msg in msgs:
+      self.recent.append(msg)
+
+    batch = {
+      'op': 'push-batch',
+      'items': msgs,
+    }
+
+    for c in self.conns:
+      if FEATURE_PUSH_BATCH in c.features:
+        await c.notify(batch)
+        continue
+
+      for msg in msgs:
+        await c.notify(dict(msg, op='push'))
+
+  def redirect(self, old_uid: int, new_uid: int):
+    self.redirects[old_uid] = new_uid
+    self.recent.remove(old_uid)
+
+    if len(self.redirects) > REDIRECTS_LIMIT:
+      self.redirects.popitem(last=False)
 
 vault_channels: dict[int, UserVaultChannel] = {}
 
-@dataclass
+class IdleReaper:
+  # disconnects clients which stopped sending anything, such as
+  # half-open connections of devices gone to sleep
+  timeout: int
+  task: Optional[asyncio.Task]
+
+  def __init__(self, timeout: int):
+    self.timeout = timeout
+
+  async def start(self):
+    self.task = asyncio.create_task(self._loop())
+
+  async def stop(self):
+    self.task.cancel()
+
+    logger.info('Waiting for idle reaper task to stop...')
+    await asyncio.wait_for(self.task, None)
+
+  async def _loop(self):
+    while True:
+      try:
+        await asyncio.sleep(self.timeout / 4)
+      except asyncio.CancelledError:
+        logger.debug('Idle reaper task cancelled')
+        return
+
+      await self.reap()
+
+  async def reap(self):
+    expired_before = time.monotonic() - self.timeout
+    conns = [
+      conn
+      for vault in vault_channels.values()
+      for conn in vault.conns
+      if not conn.busy and conn.last_seen < expired_before
+      # close already sent, waiting for the client
+      and conn.ws.application_state != WebSocketState.DISCONNECTED
+    ]
+
+    if not conns:
+      return
+
+    logger.info('Closing %d idle connections', len(conns))
+    await asyncio.gather(
+      *(conn.close(GOING_AWAY) for conn in conns),
+      return_exceptions=True,
+    )
+
+# slots keep the state of the many idle connections compact
+@dataclass(eq=False, slots=True)
 class UserSyncConn:
-  db: Session
   ws: WebSocket
   device: str
+  user_id: int
   vault: Optional[UserVaultChannel] = None
   task: Optional[asyncio.Task] = None
+  buckets: tuple[TokenBucket, ...] = field(default_factory=tuple)
+  features: frozenset[str] = frozenset()
+  binary: Optional[asyncio.Queue] = None
+  # ops being handled
+  active: int = 0
+  deflater: Optional[Deflater] = None
+  last_seen: float = field(default_factory=time.monotonic)
 
   @property
   def vault_id(self):
     return self.vault.vault_id
   
+  @property
+  def busy(self):
+    return self.active > 0 or bool(self.task and not self.task.done())
+
+  async def close(self, code: int):
+    await self.ws.close(code)
+
   def disconnect(self):
+    drainer.conns.discard(self)
+
     if self.task:
       self.task.cancel()
       self.task = None
@@ -175,7 +482,42 @@ class UserSyncConn:
       self.vault = None
   
   async def send(self, data):
-    await self.ws.send_json(data)
+    rid = request_id.get()
+    if rid is not None:
+      data = dict(data, rid=rid)
+
+    await self.send_text(encode_msg(data))
+
+  async def notify(self, data):
+    # messages not answering a request of this connection
+    await self.send_text(encode_msg(data))
+
+  async def send_text(self, text: str):
+    if FEATURE_DEFLATE not in self.features or len(text) < settings.transfer.compress_size:
+      await self.ws.send_text(text)
+      return
+
+    if not self.deflater:
+      self.deflater = Deflater(
+        level=settings.transfer.compress_level,
+        window=settings.transfer.compress_window,
+        mem_level=settings.transfer.compress_mem_level,
+      )
+
+    async with self.deflater.lock:
+      start = time.thread_time()
+      data = base64.b64encode(self.deflater.compress(text.encode())).decode()
+      frame = encode_msg({
+        'op': 'z',
+        'data': data,
+      })
+
+      compress_stats['frames'] += 1
+      compress_stats['bytes_in'] += len(text)
+      compress_stats['bytes_out'] += len(frame)
+      compress_stats['cpu_time'] += time.thread_time() - start
+
+      await self.ws.send_text(frame)
 
   async def result(self, error: str | None = None):
     msg = {
@@ -188,24 +530,134 @@ class UserSyncConn:
     await self.send(msg)
 
   async def loop(self):
+    if FEATURE_CONCURRENT not in self.features:
+      while True:
+        message = await self._receive()
+        if message.get('text') is None:
+          raise Exception('Unexpected binary frame')
+
+        await self._handle_request(json.loads(message['text']))
+
+    # only one piece is requested from the client at a time
+    self.binary = asyncio.Queue(1)
+    ops: asyncio.Queue = asyncio.Queue()
+
+    reader = asyncio.create_task(self._read_loop(ops))
+    worker = asyncio.create_task(self._ops_loop(ops))
+    try:
+      done, _ = await asyncio.wait({reader, worker}, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        task.result()
+    finally:
+      reader.cancel()
+      worker.cancel()
+
+  async def _read_loop(self, ops: asyncio.Queue):
+    assert self.binary
+    control: set[asyncio.Task] = set()
+    # each control op may take a database session
+    slots = asyncio.Semaphore(settings.transfer.control_ops)
+
+    try:
+      while True:
+        message = await self._receive()
+
+        if message.get('bytes') is not None:
+          self.binary.put_nowait(message['bytes'])
+          continue
+
+        msg = json.loads(message['text'])
+        if msg.get('op') not in CONTROL_OPS:
+          ops.put_nowait(msg)
+          continue
+
+        await slots.acquire()
+        task = asyncio.create_task(self._handle_control(msg))
+        control.add(task)
+        task.add_done_callback(control.discard)
+        task.add_done_callback(lambda _: slots.release())
+    finally:
+      for task in control:
+        task.cancel()
+
+  async def _receive(self):
+    while True:
+      try:
+        message = await receive_frame(self.ws, settings.transfer.max_text_size)
+      except FrameTooLarge as e:
+        self.last_seen = time.monotonic()
+        await self._reject_frame(e.text)
+        continue
+
+      self.last_seen = time.monotonic()
+
+      return message
+
+  async def _reject_frame(self, text: str):
+    # the frame is already buffered by the server, its rid tells the
+    # client which request to retry, such as a push-batch in smaller parts
+    try:
+      rid = json.loads(text).get('rid')
+    except (ValueError, AttributeError):
+      rid = None
+
+    token = request_id.set(rid)
+    try:
+      await self.result(f'Frame too large, the limit is {settings.transfer.max_text_size} bytes')
+    finally:
+      request_id.reset(token)
+
+  async def _ops_loop(self, ops: asyncio.Queue):
     while True:
-      msg = await self.ws.receive_json() 
+      await self._handle_request(await ops.get())
+
+  async def _handle_control(self, msg: dict):
+    try:
+      await self._handle_request(msg)
+    except Exception as e:
+      logger.warning('control op error: %s', msg['op'], exc_info=True)
+
+      # other ops go on, so the failed one gets its own answer
+      token = request_id.set(msg.get('rid'))
+      try:
+        await self.result(str(e))
+      except Exception:
+        logger.debug('failed to answer control op: %s', msg['op'], exc_info=True)
+      finally:
+        request_id.reset(token)
+
+  async def _handle_request(self, msg: dict):
+    token = request_id.set(msg.get('rid'))
+    self.active += 1
+    try:
       await self.handle(msg)
+    finally:
+      self.active -= 1
+      request_id.reset(token)
   
   @staticmethod
-  async def auth(ws: WebSocket, db: Session):
-    msg = await ws.receive_json()
+  async def auth(ws: WebSocket):
+    message = await asyncio.wait_for(
+      receive_frame(ws, settings.transfer.max_init_size),
+      settings.transfer.idle_timeout or None,
+    )
+    msg = json.loads(message['text'])
     assert msg['op'] == 'init'
 
     device = msg['device']
-    user_token = get_user_token(msg['token'], db)
 
-    conn = UserSyncConn(db, ws, device)
-    vault = UserVaultChannel.join(
-      conn, user_token.user_id, msg['id'], msg['keyhash']
-    )
-    conn.vault = vault
+    with get_session() as db:
+      user_token = get_user_token(msg['token'], db)
 
+      conn = UserSyncConn(ws, device, user_token.user_id)
+      conn.features = frozenset(msg.get('features') or ())
+      conn.buckets = scheduler.buckets(user_token.user_id)
+      vault = UserVaultChannel.join(
+        conn, db, user_token.user_id, msg['id'], msg['keyhash']
+      )
+      conn.vault = vault
+
+    drainer.conns.add(conn)
     await conn.result()
 
     conn.task = asyncio.create_task(conn.send_records(msg['version'], msg['initial']))
@@ -213,53 +665,200 @@ class UserSyncConn:
     return conn
   
   async def on_push(self, msg: dict):
+    pending = None
+    key = (self.vault_id, msg['hash'])
+    upload = None
+
     if not msg['folder'] and not msg['deleted']:
       pieces = msg['pieces']
       hash = msg['hash']
-      if pieces and not self._hash_exists(msg['hash']):
-        pending = dao.PendingFile.get_or_create(
-          self.db,
-          vault_id=self.vault_id, hash=msg['hash'], type=model.PendingFileType.UPLOAD,
-        )
 
-        await self._save_file(hash, pieces)
-        self.db.delete(pending)
-
-    record = model.DocumentRecord(
-      vault_id=self.vault_id,
-      path=msg['path'],
-      relatedpath=msg.get('relatedpath') or '',
-      hash=msg['hash'],
-      folder=msg['folder'],
-      deleted=msg['deleted'],
-      size=msg.get('size', 0),
-      device=self.device,
-      ctime=msg['ctime'],
-      mtime=msg['mtime'],
-    )
+      size = msg.get('size', 0)
+      if size_to_pieces(size) != pieces or size > SYNC_SIZE_LIMIT:
+        await self.result('Invalid size')
+        return
+
+      waited = False
+      while pieces and key in uploads:
+        # the same content is being uploaded by another device
+        waited = True
+        upload_stats['waits'] += 1
+        await uploads[key].wait()
+
+      with get_session() as db:
+        if pieces and not self._hash_exists(db, hash):
+          pending = dao.PendingFile.get_or_create(
+            db,
+            vault_id=self.vault_id, hash=hash, type=model.PendingFileType.UPLOAD,
+          )
+        elif waited:
+          upload_stats['skipped'] += 1
+
+      if pending:
+        upload = uploads[key] = asyncio.Event()
+
+    try:
+      if upload:
+        async with scheduler.slot(msg.get('size', 0)):
+          await self._save_file(msg['hash'], msg['pieces'], msg.get('size', 0))
+
+      record = model.DocumentRecord(
+        vault_id=self.vault_id,
+        path=msg['path'],
+        relatedpath=msg.get('relatedpath') or '',
+        hash=msg['hash'],
+        folder=msg['folder'],
+        deleted=msg['deleted'],
+        size=msg.get('size', 0),
+        device=self.device,
+        ctime=msg['ctime'],
+        mtime=msg['mtime'],
+      )
+
+      await self._push(record, pending, coalesce=True)
+    finally:
+      if upload:
+        # the record is committed, waiters find the hash and skip the upload
+        del uploads[key]
+        upload.set()
 
-    await self._push(record)
     await self.result()
   
+  async def on_push_batch(self, msg: dict):
+    items = msg['items']
+
+    hashes = [
+      item['hash'] for item in items
+      if not item['folder'] and not item['deleted'] and item.get('pieces')
+    ]
+
+    results = []
+    records = []
+
+    with get_session() as db:
+      existing = dao.Vault.get_existing_hashes(db, self.vault_id, hashes)
+
+      for item in items:
+        if (
+          not item['folder'] and not item['deleted']
+          and item.get('pieces') and item['hash'] not in existing
+        ):
+          # blobs are still uploaded one by one with push
+          results.append({
+            'res': 'missing-blobs',
+          })
+          continue
+
+        record = model.DocumentRecord(
+          vault_id=self.vault_id,
+          path=item['path'],
+          relatedpath=item.get('relatedpath') or '',
+          hash=item['hash'],
+          folder=item['folder'],
+          deleted=item['deleted'],
+          size=item.get('size', 0),
+          device=self.device,
+          ctime=item['ctime'],
+          mtime=item['mtime'],
+        )
+        records.append(record)
+        results.append({
+          'res': 'ok',
+        })
+
+      db.add_all(records)
+      db.flush()
+
+      msgs = [record_to_msg(record) for record in records]
+      db.commit()
+
+    uids = iter(msgs)
+    for result in results:
+      if result['res'] == 'ok':
+        result['uid'] = next(uids)['uid']
+
+    if msgs:
+      assert self.vault
+      await self.vault.push_batch(msgs)
+
+    await self.send({
+      'res': 'ok',
+      'items': results,
+    })
+
   async def _send_file(self, hash: str, pieces: int):
-    with closing(storage.get_file_object(self.vault_id, hash)) as f:
+    data = blob_cache.get(self.vault_id, hash)
+    if data is not None:
+      view = memoryview(data)
+      for i in range(pieces):
+        piece = view[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]
+        await self._throttle(len(piece))
+        # any buffer is sent as is, the annotation asks for bytes
+        await self.ws.send_bytes(cast(bytes, piece))
+
+      return
+
+    f = await asyncio.to_thread(storage.get_file_object, self.vault_id, hash)
+    with closing(f):
       for _ in range(pieces):
-        chunk = f.read(CHUNK_SIZE)
-        await self.ws.send_bytes(chunk)
+        async with buffer_pool.acquire() as buffer:
+          size = f.readinto(buffer)
+          await self._throttle(size)
+          await self.ws.send_bytes(buffer[:size])
   
-  async def _save_file(self, hash: str, pieces: int):
-    with closing(storage.get_file_object(self.vault_id, hash, False)) as f:
+  async def _save_file(self, hash: str, pieces: int, size: int):
+    chunks: Optional[list[bytes]] = [] if blob_cache.accepts(size) else None
+
+    # preallocating may write zeros on filesystems without fallocate
+    writer = await asyncio.to_thread(storage.BlobWriter, self.vault_id, hash, size)
+
+    try:
       for _ in range(pieces):
-        await self.send({
-          # HACK: anything other than 'ok'
-          'res': 'missing-blobs'
-        })
-        chunk = await self.receive_binary()
-        f.write(chunk)
+        # hold a slot before asking for the piece, so the client only
+        # sends it when the transfer memory budget allows
+        async with buffer_pool.reserve():
+          await self.send({
+            # HACK: anything other than 'ok'
+            'res': 'missing-blobs'
+          })
+          try:
+            chunk = await asyncio.wait_for(
+              self.receive_binary(),
+              settings.transfer.piece_timeout or None,
+            )
+          except asyncio.TimeoutError:
+            # the protocol can not skip a piece, so the connection ends
+            raise Exception('Timed out waiting for a piece')
+
+          writer.write(chunk)
+          await self._throttle(len(chunk))
+
+          if chunks is not None:
+            chunks.append(chunk)
+
+      writer.verify(pieces)
+    except BaseException:
+      writer.abort()
+      raise
+
+    try:
+      await blob_writes.commit(writer)
+    except Exception:
+      # on cancellation the batch still moves the verified blob in place
+      writer.abort()
+      raise
+
+    if chunks is not None:
+      blob_cache.put(self.vault_id, hash, b''.join(chunks))
   
+  async def _throttle(self, size: int):
+    for bucket in self.buckets:
+      await bucket.consume(size)
+
   async def on_pull(self, msg: dict):
     uid = msg['uid']
-    record = self._get_record(uid)
+    with get_session() as db:
+      record = self._get_record(db, uid)
     pieces = size_to_pieces(record.size)
 
     msg = {
@@ -271,12 +870,137 @@ class UserSyncConn:
     await self.send(msg)
 
     if record.size > 0:
-      await self._send_file(record.hash, pieces)
+      async with scheduler.slot(record.size):
+        await self._send_file(record.hash, pieces)
   
+  async def on_pull_batch(self, msg: dict):
+    uids: list[int] = msg['uids']
+
+    with get_session() as db:
+      found = dao.DocumentRecord.get_many(db, self.vault_id, uids)
+
+      records: list[Optional[model.DocumentRecord]] = []
+      for uid in uids:
+        record = found.get(uid)
+        if not record:
+          try:
+            record = self._get_record(db, uid)
+          except Exception:
+            pass
+
+        records.append(record)
+
+    items = []
+    for uid, record in zip(uids, records):
+      if not record:
+        items.append({
+          'uid': uid,
+          'err': 'Record not found',
+        })
+        continue
+
+      items.append({
+        'uid': uid,
+        'size': record.size,
+        'pieces': size_to_pieces(record.size),
+        'deleted': record.deleted,
+      })
+
+    await self.send({
+      'items': items,
+    })
+
+    blobs = [record for record in records if record and record.size > 0]
+    if not blobs:
+      return
+
+    total_size = sum(record.size for record in blobs)
+    async with scheduler.slot(total_size):
+      await self._send_files(blobs)
+
+  async def _send_files(self, records: list[model.DocumentRecord]):
+    queue: asyncio.Queue = asyncio.Queue(settings.transfer.readahead)
+    reader = asyncio.create_task(self._read_files(records, queue))
+
+    try:
+      while (item := await queue.get()) is not None:
+        if isinstance(item, Exception):
+          raise item
+
+        buffer, piece = item
+        try:
+          await self._throttle(len(piece))
+          await self.ws.send_bytes(piece)
+        finally:
+          if buffer is not None:
+            buffer_pool.put(buffer)
+
+      await reader
+    finally:
+      reader.cancel()
+
+      # return buffers of pieces read ahead but never sent
+      while not queue.empty():
+        item = queue.get_nowait()
+        if item and item[0] is not None:
+          buffer_pool.put(item[0])
+
+  async def _read_files(self, records: list[model.DocumentRecord], queue: asyncio.Queue):
+    # always end the queue, so the sender never waits for pieces
+    # that will not come
+    try:
+      await self._read_pieces(records, queue)
+    except Exception as e:
+      await queue.put(e)
+      return
+
+    await queue.put(None)
+
+  async def _read_pieces(self, records: list[model.DocumentRecord], queue: asyncio.Queue):
+    for record in records:
+      pieces = size_to_pieces(record.size)
+
+      data = blob_cache.get(self.vault_id, record.hash)
+      if data is not None:
+        view = memoryview(data)
+        for i in range(pieces):
+          await queue.put((None, view[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]))
+
+        continue
+
+      f = await asyncio.to_thread(storage.get_file_object, self.vault_id, record.hash)
+      with closing(f):
+        for _ in range(pieces):
+          buffer = await buffer_pool.get()
+          try:
+            size = await self._read_piece(f, buffer)
+            await queue.put((buffer, memoryview(buffer)[:size]))
+          except BaseException:
+            buffer_pool.put(buffer)
+            raise
+
+  @staticmethod
+  async def _read_piece(f, buffer: bytearray) -> int:
+    read = asyncio.ensure_future(asyncio.to_thread(f.readinto, buffer))
+
+    try:
+      return await asyncio.shield(read)
+    except asyncio.CancelledError:
+      # the thread keeps writing into the buffer and reading the file,
+      # neither may be released before it is done
+      while not read.done():
+        try:
+          await asyncio.wait([read])
+        except asyncio.CancelledError:
+          pass
+
+      raise
+
   async def get_deleted(self):
-    deleted = dao.DocumentRecord.get_deleted(self.db, self.vault_id)
+    with get_session() as db:
+      deleted = dao.DocumentRecord.get_deleted(db, self.vault_id)
 
-    items = [record_to_history(record) for record in deleted]
+      items = [record_to_history(record) for record in deleted]
     
     await self.send({
       'items': items,
@@ -285,9 +1009,10 @@ class UserSyncConn:
   async def get_history(self, msg: dict):
     path = msg['path']
     last = msg['last']
-    records = dao.DocumentRecord.get_history(self.db, self.vault_id, path, last)
+    with get_session() as db:
+      records = dao.DocumentRecord.get_history(db, self.vault_id, path, last)
 
-    items = [record_to_history(record) for record in records]
+      items = [record_to_history(record) for record in records]
     
     await self.send({
       'items': items,
@@ -297,7 +1022,8 @@ class UserSyncConn:
   async def restore(self, msg: dict):
     uid = msg['uid']
 
-    old_record = self._get_record(uid)
+    with get_session() as db:
+      old_record = self._get_record(db, uid)
 
     new_record = model.DocumentRecord(**old_record.dict(
       exclude={'id', 'deleted', 'device', 'created_at'}
@@ -307,15 +1033,22 @@ class UserSyncConn:
     await self.result()
   
   async def send_records(self, version: int, initial: bool):
-    [lastest, records] = dao.DocumentRecord.get_updates(
-      self.db, self.vault_id, version, initial,
-    )
+    assert self.vault
+    with get_session() as db:
+      recent = self.vault.recent.get(db, self.vault_id, version, initial)
 
-    for record in records:
-      msg = record_to_msg(record)
-      msg['op'] = 'push'
+    if recent:
+      recent_stats['hits'] += 1
+      lastest, payload = recent
+    else:
+      recent_stats['misses'] += 1
+      lastest, payload = await catchup.get(
+        self.vault_id, version, initial,
+        lambda: load_updates(self.vault_id, version, initial),
+      )
 
-      await self.send(msg)
+    for text in payload:
+      await self.send_text(text)
 
     await self.send({
       'op': 'ready',
@@ -323,9 +1056,12 @@ class UserSyncConn:
     })
   
   async def receive_binary(self):
+    if self.binary:
+      return await self.binary.get()
+
     while True:
-      msg = await self.ws.receive()
-      if 'text' in msg:
+      msg = await self._receive()
+      if msg.get('text') is not None:
         data = json.loads(msg['text'])
         assert data['op'] == 'ping'
 
@@ -337,34 +1073,92 @@ class UserSyncConn:
       return msg['bytes']
   
   async def get_size(self):
-    size = dao.Vault.get_size(self.db, self.vault_id)
+    with get_session() as db:
+      size = dao.Vault.get_size(db, self.vault_id)
 
     await self.send({
       'size': size,
       'limit': SYNC_SIZE_LIMIT,
     })
   
-  def _hash_exists(self, hash: str):
-    return dao.Vault.get_hash_count(self.db, self.vault_id, hash) > 0
+  def _hash_exists(self, db: Session, hash: str):
+    return dao.Vault.get_hash_count(db, self.vault_id, hash) > 0
   
-  def _get_record(self, uid: int):
-    record = dao.DocumentRecord.get(self.db, self.vault_id, uid)
+  def _get_record(self, db: Session, uid: int):
+    record = dao.DocumentRecord.get(db, self.vault_id, uid)
+
+    while not record and self.vault and uid in self.vault.redirects:
+      uid = self.vault.redirects[uid]
+      record = dao.DocumentRecord.get(db, self.vault_id, uid)
 
     if not record:
       raise Exception('Record not found')
 
     return record
   
-  async def _push(self, record: model.DocumentRecord):
-    self.db.add(record)
-    self.db.commit()
+  def _get_superseded(self, db: Session, record: model.DocumentRecord):
+    if record.folder or record.deleted or record.relatedpath:
+      return None
+
+    window = vault_access.get_coalesce_window(db, self.vault_id)
+    if not window:
+      return None
+
+    latest = dao.DocumentRecord.get_latest(db, self.vault_id, record.path)
+    if (
+      not latest
+      or latest.device != self.device
+      or latest.folder
+      or latest.deleted
+      or latest.created_at.timestamp() < time.time() - window
+    ):
+      return None
+
+    return latest
+
+  async def _push(
+    self,
+    record: model.DocumentRecord,
+    pending: Optional[model.PendingFile] = None,
+    coalesce: bool = False,
+  ):
+    released: Optional[tuple[str, int]] = None
+
+    with get_session() as db:
+      dao.route(db, self.vault_id)
+
+      superseded = self._get_superseded(db, record) if coalesce else None
+      if superseded:
+        superseded_id = superseded.id
+        db.delete(superseded)
+
+      if pending:
+        db.delete(pending)
+
+      db.add(record)
+
+      if superseded and superseded.hash != record.hash and not self._hash_exists(db, superseded.hash):
+        released = (superseded.hash, superseded.size)
+        dao.PendingFile.release(db, self.vault_id, superseded.hash)
+
+      db.commit()
+      db.refresh(record)
+
+      if superseded:
+        coalesce_stats['rows'] += 1
+
+        assert self.vault and record.id is not None
+        self.vault.redirect(superseded_id, record.id)
+
+    if released:
+      blob_cache.discard(self.vault_id, released[0])
+      coalesce_stats['bytes'] += released[1]
 
     assert self.vault
-    await self.vault.push(record)
+    await self.vault.push(record, self)
 
   async def handle(self, msg: dict):
     logger.debug('handle msg: %s', msg)
-    self.db.rollback()
 
     match msg['op']:
       case 'size':
@@ -375,8 +1169,12 @@ class UserSyncConn:
         })
       case 'push':
         await self.on_push(msg)
+      case 'push-batch':
+        await self.on_push_batch(msg)
       case 'pull':
         await self.on_pull(msg)
+      case 'pull-batch':
+        await self.on_pull_batch(msg)
       case 'deleted':
         await self.get_deleted()
       case 'history':
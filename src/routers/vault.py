@@ -1,10 +1,13 @@
 import secrets
 from typing import Optional
 from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlmodel import select, not_
 
 from .. import dao, model
+from ..archive import export_vault
+from ..cache import invalidate_vault
 from ..depends import DbSession, UserTokenInfo, get_user_token
 from ..utils import datetime_to_ts, generate_secret, get_keyhash
 
@@ -96,6 +99,8 @@ def delete_vault(db: DbSession, req: DeleteVaultRequest):
     db.add(vault)
     db.commit()
 
+    invalidate_vault(db, req.vault_uid)
+
   return {}
 
 class RenameVaultRequest(BaseModel):
@@ -115,6 +120,8 @@ def rename_vault(db: DbSession, req: RenameVaultRequest):
     db.add(vault)
     db.commit()
 
+    invalidate_vault(db, req.vault_uid)
+
   return {}
 
 class AccessVaultRequest(BaseModel):
@@ -182,9 +189,12 @@ def remove_share(db: DbSession, req: RemoveVaultShareRequest):
   if not vault:
     raise HTTPException(403)
 
-  if is_owner:
+  if req.share_uid:
+    if not req.share_uid.isdigit():
+      raise HTTPException(400)
+
     query = query.where(
-      model.VaultShare.user_id == req.share_uid,
+      model.VaultShare.user_id == int(req.share_uid),
     )
   else:
     query = query.where(
@@ -196,6 +206,8 @@ def remove_share(db: DbSession, req: RemoveVaultShareRequest):
     db.delete(share)
     db.commit()
 
+    invalidate_vault(db, req.vault_uid)
+
   return {}
 
 class InviteVaultShareRequest(BaseModel):
@@ -224,4 +236,29 @@ def invite_share(db: DbSession, req: InviteVaultShareRequest):
   db.add(vault)
   db.commit()
 
-  return {}
\ No newline at end of file
+  invalidate_vault(db, req.vault_uid)
+
+  return {}
+
+class ExportVaultRequest(BaseModel):
+  vault_uid: int
+  version: Optional[int]
+  token: str
+
+@router.post('/export')
+def export(db: DbSession, req: ExportVaultRequest):
+  user_token = get_user_token(req.token, db)
+
+  vault = dao.Vault.get(db, req.vault_uid, user_token.user_id, True)
+  if not vault:
+    raise HTTPException(403)
+
+  filename = f'vault-{vault.id}.tar'
+
+  return StreamingResponse(
+    export_vault(req.vault_uid, req.version),
+    media_type='application/x-tar',
+    headers={
+      'Content-Disposition': f'attachment; filename="{filename}"',
+    },
+  )
@@ -0,0 +1,137 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from . import model, storage
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+SHARD_NAME = 'vault.db'
+SHARD_TABLES = [
+  model.SQLModel.metadata.tables['documentrecord'],
+  model.SQLModel.metadata.tables['pendingfile'],
+]
+SPLIT_BATCH_SIZE = 1000
+
+# least recently used first
+_engines: OrderedDict[int, Engine] = OrderedDict()
+_lock = threading.Lock()
+
+def is_enabled():
+  return settings.database.shard_vaults
+
+def get_shard_path(vault_id: int):
+  return os.path.join(storage.get_vault_dir(vault_id), SHARD_NAME)
+
+def exists(vault_id: int):
+  return os.path.exists(get_shard_path(vault_id))
+
+def get_shard_engine(vault_id: int):
+  evicted = []
+
+  with _lock:
+    engine = _engines.get(vault_id)
+    if engine:
+      _engines.move_to_end(vault_id)
+      return engine
+
+    path = get_shard_path(vault_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # a fixed pool, SQLite runs one writer at a time anyway
+    engine = model.get_engine(
+      'sqlite:///' + path,
+      settings.echo,
+      pool_size=settings.database.shard_pool_size,
+      max_overflow=0,
+      pool_timeout=settings.database.pool_timeout,
+    )
+    model.SQLModel.metadata.create_all(engine, tables=SHARD_TABLES)
+
+    _engines[vault_id] = engine
+
+    while len(_engines) > settings.database.shard_engines:
+      evicted.append(_engines.popitem(last=False)[1])
+
+  # connections still checked out are closed once they are returned
+  for evicted_engine in evicted:
+    evicted_engine.dispose()
+
+  return engine
+
+def engines():
+  with _lock:
+    return list(_engines.values())
+
+def dispose_shard(vault_id: int):
+  with _lock:
+    engine = _engines.pop(vault_id, None)
+
+  if engine:
+    engine.dispose()
+
+class RoutingSession(Session):
+  def get_bind(self, mapper=None, clause=None, **kw):
+    if is_enabled() and mapper is not None and mapper.local_table in SHARD_TABLES:
+      vault_id = self.info.get('vault_id')
+      if vault_id is None:
+        raise RuntimeError('Vault data accessed before routing the session')
+
+      return get_shard_engine(vault_id)
+
+    return super().get_bind(mapper, clause=clause, **kw)
+
+def split_database(engine: Engine):
+  # without sharding the server keeps reading the main database,
+  # which would be left empty
+  if not is_enabled():
+    raise RuntimeError('database.shard_vaults must be enabled to split the database')
+
+  with engine.connect() as conn:
+    vault_ids = conn.execute(select(model.SQLModel.metadata.tables['vault'].c.id)).scalars().all()
+
+  totals = {table.name: 0 for table in SHARD_TABLES}
+  for vault_id in vault_ids:
+    shard_engine = get_shard_engine(vault_id)
+
+    for table in SHARD_TABLES:
+      with shard_engine.begin() as shard_conn:
+        # skip rows copied by a previous, interrupted run
+        last = shard_conn.execute(select(func.max(table.c.id))).scalar() or 0
+
+        with engine.connect() as conn:
+          result = conn.execution_options(stream_results=True).execute(
+            select(table).where(
+              table.c.vault_id == vault_id,
+              table.c.id > last,
+            ).order_by(table.c.id)
+          )
+
+          copied = 0
+          while rows := result.mappings().fetchmany(SPLIT_BATCH_SIZE):
+            shard_conn.execute(table.insert(), [dict(row) for row in rows])
+            copied += len(rows)
+
+      totals[table.name] += copied
+      logger.info('Copied %d rows of %s for vault %d', copied, table.name, vault_id)
+
+  with engine.begin() as conn:
+    for table in SHARD_TABLES:
+      query = select(func.count()).select_from(table).where(table.c.vault_id.in_(vault_ids))
+      count = conn.execute(query).scalar()
+      logger.info(
+        'Copied %d rows of %s in this run, deleting %d rows from the main database',
+        totals[table.name], table.name, count,
+      )
+
+      # rows of vaults missing from the vault table are left in place
+      result = conn.execute(table.delete().where(table.c.vault_id.in_(vault_ids)))
+      logger.info('Deleted %d rows of %s', result.rowcount, table.name)
+
+  logger.info('Split %d vaults out of the main database', len(vault_ids))
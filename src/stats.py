@@ -0,0 +1,12 @@
+from typing import Any, Callable
+
+_providers: dict[str, Callable[[], Any]] = {}
+
+def register(name: str, provider: Callable[[], Any]):
+  _providers[name] = provider
+
+def unregister(name: str):
+  _providers.pop(name, None)
+
+def collect():
+  return {name: provider() for name, provider in _providers.items()}
@@ -1,11 +1,25 @@
+import asyncio
+import logging
 import os
+import shutil
+import tempfile
+import time
 
+from .config import settings
+
+logger = logging.getLogger(__name__)
 
 PREFIX = 'data/blobs'
+TMP_DIR = 'tmp'
+# temp files older than this are left over from a crash, in seconds
+TMP_MAX_AGE = 60 * 60
 
 def get_vault_dir(vault_id: int):
   return os.path.join(PREFIX, str(vault_id))
 
+def get_tmp_dir(vault_id: int):
+  return os.path.join(PREFIX, str(vault_id), TMP_DIR)
+
 def get_file_path(vault_id: int, path_hash: str):
   path = os.path.join(
     PREFIX, str(vault_id),
@@ -14,12 +28,224 @@ def get_file_path(vault_id: int, path_hash: str):
   
   return path
 
+def get_cold_path(vault_id: int, path_hash: str):
+  return os.path.join(
+    settings.tiering.dir, str(vault_id),
+    path_hash[:2], path_hash[2:4], path_hash[4:],
+  )
+
+def remove_file(vault_id: int, path_hash: str):
+  for path in (get_file_path(vault_id, path_hash), get_cold_path(vault_id, path_hash)):
+    if os.path.exists(path):
+      os.remove(path)
+
 def get_file_object(vault_id: int, path_hash: str, readonly: bool = True):
   path = get_file_path(vault_id, path_hash)
 
   if not readonly:
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
-  f = open(path, 'rb' if readonly else 'wb')
+    return open(path, 'wb')
+
+  try:
+    return open(path, 'rb')
+  except FileNotFoundError:
+    pass
+
+  try:
+    if settings.tiering.promote:
+      promote_file(vault_id, path_hash)
+    else:
+      return open(get_cold_path(vault_id, path_hash), 'rb')
+  except FileNotFoundError:
+    # promoted by another reader meanwhile
+    pass
+
+  return open(path, 'rb')
+
+def _move_file(src: str, dst: str, tmp_dir: str):
+  # the tiers may be on different filesystems, so copy into a temp file
+  # next to the destination and rename it in place
+  os.makedirs(tmp_dir, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+
+  try:
+    with os.fdopen(fd, 'wb') as f, open(src, 'rb') as src_f:
+      shutil.copyfileobj(src_f, f)
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.rename(tmp_path, dst)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+  os.remove(src)
+
+def demote_file(vault_id: int, path_hash: str):
+  _move_file(
+    get_file_path(vault_id, path_hash),
+    get_cold_path(vault_id, path_hash),
+    os.path.join(settings.tiering.dir, str(vault_id), TMP_DIR),
+  )
+
+def promote_file(vault_id: int, path_hash: str):
+  _move_file(
+    get_cold_path(vault_id, path_hash),
+    get_file_path(vault_id, path_hash),
+    get_tmp_dir(vault_id),
+  )
+
+def _fsync_dir(path: str):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+class BlobWriter:
+  # writes into a temp file, which is only renamed to the blob path
+  # once complete, so a blob path never holds a partial file
+  def __init__(self, vault_id: int, path_hash: str, size: int):
+    self.path = get_file_path(vault_id, path_hash)
+    self.size = size
+    self.written = 0
+    self.pieces = 0
+
+    tmp_dir = get_tmp_dir(vault_id)
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    fd, self.tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix=path_hash + '.')
+    self.file = os.fdopen(fd, 'wb')
+
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+      try:
+        os.posix_fallocate(fd, 0, size)
+      except OSError:
+        # not supported by the filesystem
+        pass
+
+  def write(self, data: bytes):
+    self.file.write(data)
+    self.written += len(data)
+    self.pieces += 1
+
+  def verify(self, pieces: int):
+    if self.pieces != pieces or self.written != self.size:
+      raise ValueError(
+        f'Incomplete blob, pieces: {self.pieces}/{pieces}, size: {self.written}/{self.size}'
+      )
+
+  def sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.file.close()
+
+  def rename(self):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    os.replace(self.tmp_path, self.path)
+
+  def commit(self):
+    self.sync()
+    self.rename()
+    _fsync_dir(os.path.dirname(self.path))
+
+  def abort(self):
+    if not self.file.closed:
+      self.file.close()
+
+    if os.path.exists(self.tmp_path):
+      os.remove(self.tmp_path)
+
+class FsyncBatcher:
+  # commits writers of concurrent uploads together, in one thread hop,
+  # and syncs each touched directory once per batch
+  def __init__(self, delay: float):
+    self.delay = delay
+
+    self._pending: list[tuple[BlobWriter, asyncio.Future]] = []
+    self._task: asyncio.Task | None = None
+
+    self.batches = 0
+    self.commits = 0
+
+  async def commit(self, writer: BlobWriter):
+    future = asyncio.get_running_loop().create_future()
+    self._pending.append((writer, future))
+
+    if not self._task or self._task.done():
+      self._task = asyncio.create_task(self._run())
+
+    await future
+
+  async def _run(self):
+    while self._pending:
+      await asyncio.sleep(self.delay)
+
+      batch, self._pending = self._pending, []
+      try:
+        errors = await asyncio.to_thread(self._commit, [writer for writer, _ in batch])
+      except Exception as e:
+        # the renamed blobs may not be durable, fail the whole batch
+        logger.exception('Blob batch commit failed')
+        errors = [e] * len(batch)
+
+      self.batches += 1
+      self.commits += len(batch)
+
+      for (_, future), error in zip(batch, errors):
+        if future.done():
+          continue
+
+        if error:
+          future.set_exception(error)
+        else:
+          future.set_result(None)
+
+  @staticmethod
+  def _commit(writers: list[BlobWriter]):
+    errors: list[Exception | None] = []
+    dirs = set()
+
+    for writer in writers:
+      try:
+        writer.sync()
+        writer.rename()
+        dirs.add(os.path.dirname(writer.path))
+        errors.append(None)
+      except Exception as e:
+        errors.append(e)
+
+    for path in dirs:
+      _fsync_dir(path)
+
+    return errors
+
+  def stats(self):
+    return {
+      'batches': self.batches,
+      'commits': self.commits,
+    }
+
+def cleanup_tmp_files(max_age: int = TMP_MAX_AGE):
+  removed = 0
+  expired_before = time.time() - max_age
+
+  for prefix in (PREFIX, settings.tiering.dir):
+    if not os.path.isdir(prefix):
+      continue
+
+    for name in os.listdir(prefix):
+      tmp_dir = os.path.join(prefix, name, TMP_DIR)
+      if not os.path.isdir(tmp_dir):
+        continue
+
+      for tmp_name in os.listdir(tmp_dir):
+        path = os.path.join(tmp_dir, tmp_name)
+        if os.path.getmtime(path) < expired_before:
+          os.remove(path)
+          removed += 1
 
-  return f
+  logger.info('Removed %d stale temp blob files', removed)
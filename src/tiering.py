@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+import logging
+import os
+from typing import Optional
+
+from sqlmodel import not_, select
+
+from . import dao, model, shard, storage
+from .config import TieringSettings
+from .database import get_session
+
+logger = logging.getLogger(__name__)
+
+class Tiering:
+  config: TieringSettings
+  task: Optional[asyncio.Task]
+
+  def __init__(self, config: TieringSettings):
+    self.config = config
+
+  async def start(self):
+    self.task = asyncio.create_task(self._loop())
+
+  async def stop(self):
+    self.task.cancel()
+
+    logger.info('Waiting for tiering task to stop...')
+    await asyncio.wait_for(self.task, None)
+
+  async def _loop(self):
+    time_delta = datetime.timedelta(hours=self.config.interval)
+    interval = time_delta.total_seconds()
+
+    while True:
+      logger.info('Next tiering in %s', time_delta)
+      try:
+        await asyncio.sleep(interval)
+      except asyncio.CancelledError:
+        logger.debug('Tiering task cancelled')
+        return
+
+      logger.info('Tiering blobs...')
+
+      try:
+        await asyncio.to_thread(self.tier)
+      except Exception:
+        logger.exception('Tiering failed')
+
+  def tier(self):
+    before = datetime.datetime.now() - datetime.timedelta(days=self.config.age)
+
+    with get_session() as db:
+      vault_ids = db.exec(select(model.Vault.id).where(
+        not_(model.Vault.deleted),
+      )).all()
+
+    moved = 0
+    for vault_id in vault_ids:
+      if shard.is_enabled() and not shard.exists(vault_id):
+        continue
+
+      # no transaction is held while the files are copied
+      with get_session() as db:
+        hashes = dao.DocumentRecord.get_cold_hashes(db, vault_id, before)
+
+      for hash in hashes:
+        if not os.path.exists(storage.get_file_path(vault_id, hash)):
+          continue
+
+        try:
+          storage.demote_file(vault_id, hash)
+          moved += 1
+        except FileNotFoundError:
+          # removed by the purger meanwhile
+          pass
+
+    logger.info('Moved %d blobs to %s', moved, self.config.dir)
+
+    return moved
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import weakref
+import zlib
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class BufferPool:
+  def __init__(self, buffer_size: int, capacity: int, idle: int):
+    self.buffer_size = buffer_size
+    self.capacity = capacity
+    # free buffers kept for reuse, the rest is released
+    self.idle = idle
+
+    self._free: list[bytearray] = []
+    self._allocated = 0
+    self._in_use = 0
+    self._waiting = 0
+    self._semaphore = asyncio.Semaphore(capacity)
+
+  def _take(self):
+    if self._free:
+      return self._free.pop()
+
+    self._allocated += 1
+    return bytearray(self.buffer_size)
+
+  async def _acquire_slot(self):
+    self._waiting += 1
+    try:
+      await self._semaphore.acquire()
+    finally:
+      self._waiting -= 1
+
+    self._in_use += 1
+
+  def _release_slot(self):
+    self._in_use -= 1
+    self._semaphore.release()
+
+  async def get(self):
+    await self._acquire_slot()
+
+    return self._take()
+
+  def put(self, buffer: bytearray):
+    if len(self._free) < self.idle:
+      self._free.append(buffer)
+    else:
+      self._allocated -= 1
+
+    self._release_slot()
+
+  @asynccontextmanager
+  async def reserve(self):
+    # a slot for a chunk held elsewhere, such as a received piece,
+    # counted against the same budget without allocating a buffer
+    await self._acquire_slot()
+
+    try:
+      yield
+    finally:
+      self._release_slot()
+
+  @asynccontextmanager
+  async def acquire(self):
+    buffer = await self.get()
+
+    try:
+      yield memoryview(buffer)
+    finally:
+      self.put(buffer)
+
+  def stats(self):
+    return {
+      'buffer_size': self.buffer_size,
+      'capacity': self.capacity,
+      'allocated': self._allocated,
+      'in_use': self._in_use,
+      'waiting': self._waiting,
+      'utilization': self._in_use / self.capacity,
+    }
+
+
+class TokenBucket:
+  def __init__(self, rate: int, burst: int):
+    # bytes per second, 0 means unlimited
+    self.rate = rate
+    self.burst = burst
+
+    self._tokens = float(burst)
+    self._updated = time.monotonic()
+
+  async def consume(self, amount: int):
+    if not self.rate:
+      return
+
+    now = time.monotonic()
+    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+    # allow going into debt, so pieces larger than the burst still pass
+    self._tokens -= amount
+    if self._tokens < 0:
+      await asyncio.sleep(-self._tokens / self.rate)
+
+
+class TransferScheduler:
+  def __init__(
+    self,
+    concurrency: int,
+    small_size: int,
+    small_slots: int,
+    conn_rate: int,
+    user_rate: int,
+  ):
+    self.concurrency = concurrency
+    self.small_size = small_size
+    self.small_slots = small_slots
+    self.conn_rate = conn_rate
+    self.user_rate = user_rate
+
+    self._active = 0
+    self._queue: list[tuple[int, int, asyncio.Future]] = []
+    self._seq = itertools.count()
+    self._user_buckets: weakref.WeakValueDictionary[int, TokenBucket] = weakref.WeakValueDictionary()
+
+    self._admitted = 0
+    self._queued = 0
+    self._wait_total = 0.0
+    self._wait_max = 0.0
+
+  def _admissible(self, small: bool):
+    if self._active < self.concurrency:
+      return True
+
+    return small and self._active < self.concurrency + self.small_slots
+
+  def _wake(self):
+    while self._queue:
+      priority, _, future = self._queue[0]
+      if future.done():
+        heapq.heappop(self._queue)
+        continue
+
+      if not self._admissible(priority == 0):
+        break
+
+      heapq.heappop(self._queue)
+      self._active += 1
+      future.set_result(None)
+
+  def _release(self):
+    self._active -= 1
+    self._wake()
+
+  @asynccontextmanager
+  async def slot(self, size: int):
+    small = size <= self.small_size
+    start = time.monotonic()
+
+    # small transfers only queue behind other small ones
+    ahead = self._queue and (not small or self._queue[0][0] == 0)
+    if not ahead and self._admissible(small):
+      self._active += 1
+    else:
+      future = asyncio.get_running_loop().create_future()
+      heapq.heappush(self._queue, (0 if small else 1, next(self._seq), future))
+      self._queued += 1
+
+      try:
+        await future
+      except asyncio.CancelledError:
+        if future.done() and not future.cancelled():
+          # slot was handed over right before cancellation
+          self._release()
+        raise
+
+    wait = time.monotonic() - start
+    self._admitted += 1
+    self._wait_total += wait
+    self._wait_max = max(self._wait_max, wait)
+
+    if wait > 0.1:
+      logger.debug('transfer waited %.3fs for a slot, size: %d', wait, size)
+
+    try:
+      yield wait
+    finally:
+      self._release()
+
+  def buckets(self, user_id: int):
+    conn_bucket = TokenBucket(self.conn_rate, self.conn_rate)
+
+    user_bucket = self._user_buckets.get(user_id)
+    if not user_bucket:
+      user_bucket = TokenBucket(self.user_rate, self.user_rate)
+      self._user_buckets[user_id] = user_bucket
+
+    return conn_bucket, user_bucket
+
+  def stats(self):
+    return {
+      'concurrency': self.concurrency,
+      'active': self._active,
+      'queued': len(self._queue),
+      'admitted': self._admitted,
+      'queued_total': self._queued,
+      'wait_avg': self._wait_total / self._admitted if self._admitted else 0,
+      'wait_max': self._wait_max,
+    }
+
+class Deflater:
+  # one raw deflate stream per connection, flushed after every frame,
+  # so the client inflates the frames in order with a single stream
+  def __init__(self, level: int, window: int, mem_level: int):
+    self._compressor = zlib.compressobj(level, zlib.DEFLATED, -window, mem_level)
+    # frames must be sent in the order they were compressed
+    self.lock = asyncio.Lock()
+
+  def compress(self, data: bytes) -> bytes:
+    return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from typing import Optional
@@ -5,8 +6,14 @@ from typing import Optional
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.responses import JSONResponse
 
+from .backup import Backup
+from .cache import InvalidationListener
+from .checkpointer import Checkpointer
+from .drain import drainer
+from . import database, storage
 from .config import settings
 from .purger import Purger
+from .tiering import Tiering
 from .routers import subscription, sync, user, vault
 
 logger = logging.getLogger(__name__)
@@ -14,13 +21,62 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def app_context(app: FastAPI):
   purger: Optional[Purger] = None
+  backup: Optional[Backup] = None
+  checkpointer: Optional[Checkpointer] = None
+  tiering: Optional[Tiering] = None
+  reaper: Optional[sync.IdleReaper] = None
+
+  await asyncio.to_thread(database.run_migrations)
+  engine = database.get_engine()
+
+  await asyncio.to_thread(storage.cleanup_tmp_files)
+  listener: Optional[InvalidationListener] = None
 
   if settings.purge.enabled:
     purger = Purger(config=settings.purge)
     await purger.start()
 
+  if settings.tiering.enabled:
+    tiering = Tiering(config=settings.tiering)
+    await tiering.start()
+
+  if settings.checkpoint.enabled and engine.dialect.name == 'sqlite':
+    checkpointer = Checkpointer(config=settings.checkpoint)
+    await checkpointer.start()
+
+  if settings.backup.enabled:
+    backup = Backup(config=settings.backup)
+    await backup.start()
+
+  if engine.dialect.name == 'postgresql':
+    listener = InvalidationListener(engine)
+    await listener.start()
+
+  if settings.transfer.idle_timeout:
+    reaper = sync.IdleReaper(settings.transfer.idle_timeout)
+    await reaper.start()
+
+  await drainer.start()
+
   yield
 
+  await drainer.stop()
+
+  if reaper:
+    await reaper.stop()
+
+  if listener:
+    await listener.stop()
+
+  if backup:
+    await backup.stop()
+
+  if checkpointer:
+    await checkpointer.stop()
+
+  if tiering:
+    await tiering.stop()
+
   if purger:
     await purger.stop()
 
@@ -0,0 +1,111 @@
+# peak RSS of concurrent blob uploads and pulls, each setting in its own
+# process: python tests/bench_transfer.py [clients] [blob MiB]
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+
+def rss():
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def run(clients: int, blob_size: int):
+  os.chdir(tempfile.mkdtemp())
+  os.makedirs('data')
+  os.environ['DATABASE__URL'] = 'sqlite:///data/data.db'
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+  from fastapi.testclient import TestClient
+  from sqlmodel import Session
+
+  from src import database, model
+  from src.routers.sync import CHUNK_SIZE, buffer_pool, size_to_pieces
+  from src.utils import generate_secret, hash_password
+  from src.web import app
+  from sync_client import init
+
+  with TestClient(app) as client:
+    salt = generate_secret()
+    with Session(database.get_engine()) as db:
+      db.add(model.User(name='bench', email='bench@example.com', password=hash_password('pw', salt), salt=salt))
+      db.commit()
+
+    token = client.post('/user/signin', json={'email': 'bench@example.com', 'password': 'pw'}).json()['token']
+    # a vault each, so no client reads push notifications of the others
+    for i in range(clients):
+      client.post('/vault/create', json={'name': f'bench{i}', 'keyhash': 'kh', 'salt': 's', 'token': token})
+    vault_ids = [vault['id'] for vault in client.post('/vault/list', json={'token': token}).json()['vaults']]
+
+    # the pieces sent by the clients are shared, only the server side grows
+    piece = os.urandom(CHUNK_SIZE)
+    pieces = size_to_pieces(blob_size)
+
+    def transfer(i: int):
+      with client.websocket_connect('/sync') as ws:
+        init(ws, token, vault_ids[i], f'bench{i}')
+        ws.send_json({
+          'op': 'push',
+          'path': f'{i}.bin',
+          'hash': uuid.uuid4().hex,
+          'folder': False,
+          'deleted': False,
+          'size': blob_size,
+          'pieces': pieces,
+          'ctime': 1,
+          'mtime': 1,
+        })
+
+        for n in range(pieces):
+          assert ws.receive_json()['res'] == 'missing-blobs'
+          ws.send_bytes(piece if n < pieces - 1 else piece[:blob_size - n * CHUNK_SIZE])
+
+        uid = ws.receive_json()['uid']
+        assert ws.receive_json()['res'] == 'ok'
+
+        ws.send_json({'op': 'pull', 'uid': uid})
+        ws.receive_json()
+        for _ in range(pieces):
+          ws.receive_bytes()
+
+    before = rss()
+    peak = before
+    done = threading.Event()
+
+    def sample():
+      nonlocal peak
+      while not done.wait(0.005):
+        peak = max(peak, rss())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+
+    threads = [threading.Thread(target=transfer, args=(i,)) for i in range(clients)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    done.set()
+    sampler.join()
+    stats = buffer_pool.stats()
+
+  print(
+    f'buffers={stats["capacity"]:<3} clients={clients} blob={blob_size >> 20}MiB '
+    f'peak RSS +{(peak - before) >> 20}MiB, buffers allocated: {stats["allocated"]}'
+  )
+
+def main():
+  clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+  blob_size = (int(sys.argv[2]) if len(sys.argv) > 2 else 16) << 20
+
+  for buffers in (4, 32):
+    env = dict(os.environ, TRANSFER__BUFFERS=str(buffers), BENCH_CHILD='1')
+    subprocess.run([sys.executable, __file__, str(clients), str(blob_size >> 20)], env=env, check=True)
+
+if __name__ == '__main__':
+  if os.environ.get('BENCH_CHILD'):
+    run(int(sys.argv[1]), int(sys.argv[2]) << 20)
+  else:
+    main()
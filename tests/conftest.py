@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# settings and storage paths are resolved on import, relative to the
+# working directory, so the server runs in a scratch dir of its own
+os.chdir(tempfile.mkdtemp())
+os.makedirs('data')
+os.environ['DATABASE__URL'] = os.environ.get('TEST_DATABASE_URL', 'sqlite:///data/data.db')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlmodel import Session
+
+from src import database, model
+from src.utils import generate_secret, hash_password
+from src.web import app
+
+@pytest.fixture(scope='session')
+def client():
+  url = os.environ['DATABASE__URL']
+  if url.startswith('postgresql'):
+    # a scratch database, blobs of an earlier run are gone with its dir
+    with create_engine(url).begin() as conn:
+      conn.execute(text('DROP SCHEMA public CASCADE'))
+      conn.execute(text('CREATE SCHEMA public'))
+
+  with TestClient(app) as client:
+    yield client
+
+@pytest.fixture(scope='session')
+def engine(client):
+  return database.get_engine()
+
+@pytest.fixture
+def make_user(client, engine):
+  def make_user():
+    email = f'{uuid.uuid4().hex}@example.com'
+    salt = generate_secret()
+
+    with Session(engine) as db:
+      user = model.User(name=email, email=email, password=hash_password('pw', salt), salt=salt)
+      db.add(user)
+      db.commit()
+      user_id = user.id
+
+    res = client.post('/user/signin', json={'email': email, 'password': 'pw'}).json()
+
+    return {
+      'id': user_id,
+      'email': email,
+      'token': res['token'],
+    }
+
+  return make_user
+
+@pytest.fixture
+def user(make_user):
+  return make_user()
+
+@pytest.fixture
+def vault_id(client, user):
+  client.post('/vault/create', json={'name': 'test', 'keyhash': 'kh', 'salt': 's', 'token': user['token']})
+  vaults = client.post('/vault/list', json={'token': user['token']}).json()['vaults']
+
+  return vaults[0]['id']
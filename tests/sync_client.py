@@ -0,0 +1,70 @@
+from starlette.testclient import WebSocketTestSession
+
+from src.routers.sync import CHUNK_SIZE, size_to_pieces
+
+def init(ws: WebSocketTestSession, token: str, vault_id: int, device: str, version: int = 0, initial: bool = True, **kwargs):
+  ws.send_json({
+    'op': 'init',
+    'token': token,
+    'id': str(vault_id),
+    'keyhash': 'kh',
+    'version': version,
+    'initial': initial,
+    'device': device,
+    **kwargs,
+  })
+  assert ws.receive_json() == {'res': 'ok'}
+
+  # catch-up records before ready
+  records: list[dict] = []
+  while True:
+    msg = ws.receive_json()
+    if msg.get('op') == 'ready':
+      return records
+
+    records.append(msg)
+
+def push(ws: WebSocketTestSession, path: str, data: bytes, hash: str, mtime: int = 1):
+  pieces = size_to_pieces(len(data))
+  ws.send_json({
+    'op': 'push',
+    'path': path,
+    'hash': hash,
+    'folder': False,
+    'deleted': False,
+    'size': len(data),
+    'pieces': pieces,
+    'ctime': 1,
+    'mtime': mtime,
+  })
+
+  # blobs the vault already has are not uploaded again
+  notify = ws.receive_json()
+  for i in range(pieces):
+    if notify != {'res': 'missing-blobs'}:
+      break
+
+    ws.send_bytes(data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE])
+    notify = ws.receive_json()
+
+  assert notify['op'] == 'push'
+  assert ws.receive_json() == {'res': 'ok'}
+
+  return notify
+
+def delete(ws: WebSocketTestSession, path: str, mtime: int = 1):
+  ws.send_json({
+    'op': 'push',
+    'path': path,
+    'hash': '',
+    'folder': False,
+    'deleted': True,
+    'ctime': 1,
+    'mtime': mtime,
+  })
+
+  notify = ws.receive_json()
+  assert notify['op'] == 'push'
+  assert ws.receive_json() == {'res': 'ok'}
+
+  return notify
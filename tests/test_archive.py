@@ -0,0 +1,69 @@
+import io
+import json
+import tarfile
+
+from src import archive
+from sync_client import delete, init, push
+
+def export(client, user, vault_id, **kwargs):
+  res = client.post('/vault/export', json={'vault_uid': vault_id, 'token': user['token'], **kwargs})
+  assert res.headers['content-type'] == 'application/x-tar'
+
+  return res.content
+
+def members(data: bytes):
+  with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+    return {
+      member.name: tar.extractfile(member).read()  # type: ignore[union-attr]
+      for member in tar
+    }
+
+def test_export_import_round_trip(client, user, vault_id, monkeypatch):
+  # a tiny spool moves the metadata and hash list to disk
+  monkeypatch.setattr(archive, 'SPOOL_SIZE', 16)
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    push(ws, 'a.md', b'same', f'{1:064x}')
+    push(ws, 'b.md', b'same', f'{1:064x}')
+    first = push(ws, 'c.md', b'old', f'{2:064x}')
+    push(ws, 'c.md', b'new', f'{3:064x}', mtime=2)
+    push(ws, 'gone.md', b'gone', f'{4:064x}')
+    delete(ws, 'gone.md', mtime=2)
+
+  files = members(export(client, user, vault_id))
+
+  meta = json.loads(files.pop(archive.META_NAME))
+  assert meta['vault_id'] == vault_id
+  assert {item['path']: item['hash'] for item in meta['records']} == {
+    'a.md': f'{1:064x}',
+    'b.md': f'{1:064x}',
+    'c.md': f'{3:064x}',
+  }
+  # a blob shared by two paths is exported once
+  assert files == {
+    archive.BLOB_PREFIX + f'{1:064x}': b'same',
+    archive.BLOB_PREFIX + f'{3:064x}': b'new',
+  }
+
+  client.post('/vault/create', json={'name': 'copy', 'keyhash': 'kh', 'salt': 's', 'token': user['token']})
+  vaults = client.post('/vault/list', json={'token': user['token']}).json()['vaults']
+  copy_id = max(vault['id'] for vault in vaults)
+
+  data = export(client, user, vault_id)
+  assert archive.import_vault(copy_id, io.BytesIO(data)) == 3
+
+  copy = members(export(client, user, copy_id))
+  copy_meta = json.loads(copy.pop(archive.META_NAME))
+  assert copy_meta['records'] == [dict(item, device='import') for item in meta['records']]
+  assert copy == files
+
+  # an older version leaves the later edit out
+  old = members(export(client, user, vault_id, version=int(first['uid'])))
+  old_meta = json.loads(old.pop(archive.META_NAME))
+  assert old_meta['version'] == int(first['uid'])
+  assert {item['path']: item['hash'] for item in old_meta['records']} == {
+    'a.md': f'{1:064x}',
+    'b.md': f'{1:064x}',
+    'c.md': f'{2:064x}',
+  }
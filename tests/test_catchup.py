@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+import pytest
+
+from src.catchup import CatchupCache
+
+def make_cache(ttl=60.0, memory=1024):
+  return CatchupCache(ttl=ttl, concurrency=4, jitter=0, memory=memory)
+
+def loader(calls, texts=('x' * 10,)):
+  def load():
+    calls.append(1)
+    # long enough for concurrent callers to find it in flight
+    time.sleep(0.05)
+    return len(calls), list(texts)
+
+  return load
+
+def test_concurrent_gets_share_one_query():
+  cache = make_cache()
+  calls = []
+
+  async def main():
+    load = loader(calls)
+    return await asyncio.gather(*(cache.get(1, 0, True, load) for _ in range(5)))
+
+  results = asyncio.run(main())
+
+  assert calls == [1]
+  assert all(result == (1, ['x' * 10]) for result in results)
+  assert cache.stats()['shared'] == 4
+
+  # cached after the load
+  assert asyncio.run(cache.get(1, 0, True, loader(calls))) == (1, ['x' * 10])
+  assert cache.stats()['hits'] == 1
+
+def test_invalidate_drops_cached_and_inflight():
+  cache = make_cache()
+  calls = []
+
+  async def main():
+    first = asyncio.create_task(cache.get(1, 0, True, loader(calls)))
+    await asyncio.sleep(0.01)
+
+    # a push while the query runs, its result must not be cached
+    cache.invalidate(1)
+    assert (await first)[0] == 1
+
+    return await cache.get(1, 0, True, loader(calls))
+
+  assert asyncio.run(main())[0] == 2
+  assert len(calls) == 2
+
+  cache.invalidate(1)
+  assert cache.stats()['cached_vaults'] == 0
+  assert cache.stats()['size'] == 0
+
+def test_expired_entries_are_evicted():
+  cache = make_cache(ttl=0.01)
+  calls = []
+
+  asyncio.run(cache.get(1, 0, True, loader(calls)))
+  assert cache.stats()['cached_vaults'] == 1
+
+  time.sleep(0.02)
+
+  # the vault that went quiet is swept when another one is cached
+  asyncio.run(cache.get(2, 0, True, loader(calls)))
+  assert cache.stats()['cached_vaults'] == 1
+
+  time.sleep(0.02)
+
+  def fail():
+    raise RuntimeError()
+
+  # and evicted on a read miss, even when the new query fails
+  with pytest.raises(RuntimeError):
+    asyncio.run(cache.get(2, 0, True, fail))
+
+  assert cache.stats()['cached_vaults'] == 0
+  assert cache.stats()['size'] == 0
+
+def test_memory_budget_evicts_least_recently_used_vaults():
+  cache = make_cache(memory=100)
+  calls = []
+
+  for vault_id in range(5):
+    asyncio.run(cache.get(vault_id, 0, True, loader(calls, ['x' * 30])))
+
+  stats = cache.stats()
+  assert stats['cached_vaults'] == 3
+  assert stats['size'] == 90
+  assert list(cache._cached) == [2, 3, 4]
+
+  # larger than the whole budget, not cached at all
+  asyncio.run(cache.get(9, 0, True, loader(calls, ['x' * 200])))
+  assert 9 not in cache._cached
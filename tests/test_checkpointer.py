@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+from src.checkpointer import Checkpointer
+from src.config import CheckpointSettings
+
+@pytest.fixture
+def wal_engine(tmp_path):
+  path = str(tmp_path / 'wal.db')
+  engine = create_engine(f'sqlite:///{path}')
+
+  with engine.begin() as conn:
+    conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+    conn.exec_driver_sql('PRAGMA wal_autocheckpoint=0')
+    conn.exec_driver_sql('CREATE TABLE t (data BLOB)')
+
+  # the WAL is removed once the last connection closes
+  keep = sqlite3.connect(path)
+  keep.execute('SELECT count(*) FROM t').fetchone()
+  yield engine
+
+  keep.close()
+  engine.dispose()
+
+def write(engine, count=1):
+  with engine.begin() as conn:
+    for _ in range(count):
+      conn.exec_driver_sql('INSERT INTO t VALUES (randomblob(4096))')
+
+def wal_size(engine):
+  return os.path.getsize(engine.url.database + '-wal')
+
+def test_checkpointed_wal_does_not_restart_again(wal_engine):
+  checkpointer = Checkpointer(CheckpointSettings(restart_size=64 * 1024, truncate_size=1 << 30))
+
+  write(wal_engine, 100)
+  checkpointer._checkpoint(wal_engine)
+  assert checkpointer.counts['PASSIVE'] == 1
+
+  # the file keeps its size, but nothing is left to copy back
+  assert wal_size(wal_engine) > 64 * 1024
+  for _ in range(3):
+    checkpointer._checkpoint(wal_engine)
+
+  assert checkpointer.counts['RESTART'] == 0
+  assert checkpointer.stats()['databases'][wal_engine.url.database]['backlog_frames'] == 0
+
+def test_reader_backlog_restarts(wal_engine):
+  checkpointer = Checkpointer(CheckpointSettings(restart_size=64 * 1024, busy_timeout=10))
+
+  reader = sqlite3.connect(wal_engine.url.database)
+  reader.execute('BEGIN')
+  reader.execute('SELECT count(*) FROM t').fetchone()
+
+  write(wal_engine, 100)
+  checkpointer._checkpoint(wal_engine)
+  checkpointer._checkpoint(wal_engine)
+  assert checkpointer.counts['RESTART'] == 1
+
+  reader.rollback()
+  reader.close()
+
+  checkpointer._checkpoint(wal_engine)
+  checkpointer._checkpoint(wal_engine)
+  assert checkpointer.counts['RESTART'] == 2
+  assert checkpointer.counts['PASSIVE'] == 2
+
+def test_truncate_waits_for_quiet_writes(wal_engine):
+  checkpointer = Checkpointer(CheckpointSettings(truncate_size=64 * 1024, quiet_period=1))
+
+  write(wal_engine, 100)
+  checkpointer._checkpoint(wal_engine)
+
+  # writes reuse the WAL from its start, the file size stays the same
+  for _ in range(5):
+    time.sleep(0.3)
+    write(wal_engine)
+    checkpointer._checkpoint(wal_engine)
+
+  assert checkpointer.counts['TRUNCATE'] == 0
+
+  time.sleep(1.1)
+  checkpointer._checkpoint(wal_engine)
+  assert checkpointer.counts['TRUNCATE'] == 1
+  assert wal_size(wal_engine) == 0
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+from sqlmodel import Session, select
+
+from src import model, storage
+from src.cache import vault_access
+from src.config import settings
+from src.purger import Purger
+from src.routers.sync import recent_stats
+from sync_client import init, push
+
+@pytest.fixture
+def coalescing(engine, vault_id):
+  with Session(engine) as db:
+    vault = db.get(model.Vault, vault_id)
+    vault.coalesce_window = 60
+    db.add(vault)
+    db.commit()
+
+  vault_access.invalidate(vault_id)
+
+def pending_files(engine, vault_id):
+  with Session(engine) as db:
+    return db.exec(select(model.PendingFile).where(
+      model.PendingFile.vault_id == vault_id,
+    )).all()
+
+def test_quick_saves_replace_the_row(client, engine, user, vault_id, coalescing):
+  with client.websocket_connect('/sync') as ws, client.websocket_connect('/sync') as other:
+    init(ws, user['token'], vault_id, 'd1')
+    init(other, user['token'], vault_id, 'd2')
+
+    records = []
+    for i in range(3):
+      records.append(push(ws, 'c.md', b'save %d' % i, f'{i:064x}', mtime=i))
+      other.receive_json()
+
+    ws.send_json({'op': 'history', 'path': 'c.md', 'last': 0})
+    assert [item['uid'] for item in ws.receive_json()['items']] == [records[-1]['uid']]
+
+    # a device that saw the first save pulls what replaced it
+    other.send_json({'op': 'pull', 'uid': records[0]['uid']})
+    assert other.receive_json()['size'] == 6
+    assert other.receive_bytes() == b'save 2'
+
+def test_released_blob_waits_for_purge(client, engine, user, vault_id, coalescing, monkeypatch):
+  hashes = [f'{i + 10:064x}' for i in range(2)]
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    for i, hash in enumerate(hashes):
+      push(ws, 'c.md', b'save %d' % i, hash, mtime=i)
+
+  released = pending_files(engine, vault_id)
+  assert [(f.hash, f.type) for f in released] == [(hashes[0], model.PendingFileType.DELETE)]
+  # still there for reads that started before
+  assert os.path.exists(storage.get_file_path(vault_id, hashes[0]))
+
+  # uploaded again by another device, before the purger got to it
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd2')
+    push(ws, 'd.md', b'save 0', hashes[0])
+
+  assert pending_files(engine, vault_id) == []
+
+  monkeypatch.setattr(settings.purge, 'released_age', 0)
+  Purger(settings.purge).purge()
+  assert os.path.exists(storage.get_file_path(vault_id, hashes[0]))
+
+def test_released_blob_is_purged(client, engine, user, vault_id, coalescing, monkeypatch):
+  hashes = [f'{i + 20:064x}' for i in range(2)]
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    for i, hash in enumerate(hashes):
+      push(ws, 'c.md', b'save %d' % i, hash, mtime=i)
+
+  monkeypatch.setattr(settings.purge, 'released_age', 0)
+  Purger(settings.purge).purge()
+
+  assert pending_files(engine, vault_id) == []
+  assert not os.path.exists(storage.get_file_path(vault_id, hashes[0]))
+  assert os.path.exists(storage.get_file_path(vault_id, hashes[1]))
+
+def test_reconnect_catch_up_skips_coalesced_records(client, user, vault_id, coalescing):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+
+    first = push(ws, 'e.md', b'save 0', f'{30:064x}', mtime=0)
+    other = push(ws, 'f.md', b'other', f'{31:064x}')
+    last = push(ws, 'e.md', b'save 1', f'{32:064x}', mtime=1)
+
+    ws.send_json({'op': 'history', 'path': 'e.md', 'last': 0})
+    assert [item['uid'] for item in ws.receive_json()['items']] == [last['uid']]
+
+    # versions before, at and after the replaced record
+    for version, expected in [
+      (0, [other, last]),
+      (first['uid'], [other, last]),
+      (other['uid'], [last]),
+    ]:
+      hits = recent_stats['hits']
+
+      with client.websocket_connect('/sync') as reconnect:
+        records = init(reconnect, user['token'], vault_id, 'd2', version=version, initial=False)
+
+      # served from the recent records, not the database
+      assert recent_stats['hits'] == hits + 1
+      assert [record['uid'] for record in records] == [record['uid'] for record in expected]
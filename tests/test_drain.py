@@ -0,0 +1,72 @@
+import asyncio
+import os
+import signal
+from types import SimpleNamespace
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from src import drain
+from src.config import DrainSettings
+from src.drain import SERVICE_RESTART, Drainer, drainer
+
+class Conn:
+  def __init__(self, drainer: Drainer, busy: bool = False):
+    self.drainer = drainer
+    self.busy = busy
+    self.codes: list[int] = []
+
+    drainer.conns.add(self)
+
+  async def close(self, code: int):
+    self.codes.append(code)
+    # as the disconnect of a sync connection does
+    self.drainer.conns.discard(self)
+
+@pytest.fixture
+def kills(monkeypatch):
+  # the drained process exits, record the signal instead
+  kills: list[int] = []
+  monkeypatch.setattr(drain, 'os', SimpleNamespace(getpid=os.getpid, kill=lambda pid, sig: kills.append(sig)))
+
+  return kills
+
+def test_new_connections_are_closed_while_draining(client, monkeypatch):
+  monkeypatch.setattr(drainer, 'draining', True)
+
+  with client.websocket_connect('/sync') as ws:
+    with pytest.raises(WebSocketDisconnect) as e:
+      ws.receive_json()
+
+  assert e.value.code == SERVICE_RESTART
+
+def test_busy_connections_are_closed_once_idle(kills):
+  drainer = Drainer(DrainSettings(signal=False, deadline=10, stagger=0))
+  idle, busy = Conn(drainer), Conn(drainer, busy=True)
+
+  async def main():
+    drainer.drain()
+    await asyncio.sleep(0.1)
+    assert idle.codes == [SERVICE_RESTART]
+    assert busy.codes == []
+
+    busy.busy = False
+    await asyncio.wait_for(drainer.task, 2)
+
+  asyncio.run(main())
+
+  assert busy.codes == [SERVICE_RESTART]
+  assert kills == [signal.SIGTERM]
+
+def test_deadline_closes_busy_connections(kills):
+  drainer = Drainer(DrainSettings(signal=False, deadline=0.2, stagger=0))
+  busy = Conn(drainer, busy=True)
+
+  async def main():
+    drainer.drain()
+    await asyncio.wait_for(drainer.task, 2)
+
+  asyncio.run(main())
+
+  assert busy.codes == [SERVICE_RESTART]
+  assert kills == [signal.SIGTERM]
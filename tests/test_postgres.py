@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import text
+from sqlmodel import Session
+
+from src import database, model, storage
+from src.cache import NOTIFY_CHANNEL, vault_access
+from src.config import settings
+from src.purger import Purger
+from sync_client import init, push
+
+@pytest.fixture(autouse=True)
+def postgresql(engine):
+  if engine.dialect.name != 'postgresql':
+    pytest.skip('set TEST_DATABASE_URL to a PostgreSQL database')
+
+def test_migrations_rerun(engine):
+  database._migrated = False
+  database.run_migrations()
+
+  with engine.connect() as conn:
+    tables = conn.execute(text(
+      "SELECT count(*) FROM information_schema.tables WHERE table_name = 'documentrecord'"
+    )).scalar()
+
+  assert tables == 1
+
+def test_shared_vault(client, make_user, user, vault_id):
+  guest = make_user()
+
+  res = client.post('/vault/share/invite', json={'vault_uid': vault_id, 'email': guest['email'], 'token': user['token']})
+  assert res.json() == {}
+
+  shared = client.post('/vault/list', json={'token': guest['token']}).json()['shared']
+  assert [vault['id'] for vault in shared] == [vault_id]
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, guest['token'], vault_id, 'guest')
+    push(ws, 'a.md', b'shared', 'hash-shared')
+
+  shares = client.post('/vault/share/list', json={'vault_uid': vault_id, 'token': user['token']}).json()['shares']
+  assert [share['uid'] for share in shares] == [str(guest['id'])]
+
+  res = client.post('/vault/share/remove', json={'vault_uid': vault_id, 'share_uid': str(guest['id']), 'token': user['token']})
+  assert res.json() == {}
+
+  shared = client.post('/vault/list', json={'token': guest['token']}).json()['shared']
+  assert shared == []
+
+def test_access_invalidation_notify(client, engine, user, vault_id):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+
+  assert vault_id in vault_access._access
+
+  # as sent by another node sharing the database
+  with Session(engine) as db:
+    db.execute(text('SELECT pg_notify(:channel, :payload)'), {
+      'channel': NOTIFY_CHANNEL,
+      'payload': str(vault_id),
+    })
+    db.commit()
+
+  deadline = time.monotonic() + 5
+  while vault_id in vault_access._access and time.monotonic() < deadline:
+    time.sleep(0.05)
+
+  assert vault_id not in vault_access._access
+
+def test_purge(client, engine, user, vault_id):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    push(ws, 'a.md', b'purged', 'hash-purged')
+
+  client.post('/vault/delete', json={'vault_uid': vault_id, 'token': user['token']})
+
+  Purger(settings.purge).purge()
+
+  with Session(engine) as db:
+    assert db.get(model.Vault, vault_id) is None
+  assert not os.path.exists(storage.get_vault_dir(vault_id))
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from src import shard, storage
+from src.config import settings
+from src.purger import Purger
+
+@pytest.fixture(autouse=True)
+def sharded(engine, monkeypatch):
+  if engine.dialect.name != 'sqlite':
+    pytest.skip('vault databases are SQLite only')
+
+  monkeypatch.setattr(settings.database, 'shard_vaults', True)
+  yield
+
+  for vault_id in list(shard._engines):
+    shard.dispose_shard(vault_id)
+
+def test_engine_cache_is_bounded(monkeypatch):
+  monkeypatch.setattr(settings.database, 'shard_engines', 2)
+
+  engines = [shard.get_shard_engine(vault_id) for vault_id in range(9001, 9005)]
+  assert list(shard._engines) == [9003, 9004]
+
+  # used again, so the other one is evicted next
+  assert shard.get_shard_engine(9003) is engines[2]
+  shard.get_shard_engine(9001)
+  assert list(shard._engines) == [9003, 9001]
+
+def test_purge_skips_vaults_without_database(vault_id):
+  path = shard.get_shard_path(vault_id)
+  assert not os.path.exists(path)
+
+  Purger(settings.purge).purge()
+
+  assert not os.path.exists(path)
+  assert not os.path.exists(storage.get_vault_dir(vault_id))
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import os
+import time
+
+import pytest
+
+from src import storage
+from src.storage import BlobWriter, FsyncBatcher
+
+# vault dirs of their own, apart from the vaults of the sync tests
+vault_ids = itertools.count(1_000_000)
+
+def tmp_files(vault_id: int):
+  return os.listdir(storage.get_tmp_dir(vault_id))
+
+def test_writer_commits_complete_blob():
+  vault_id = next(vault_ids)
+  writer = BlobWriter(vault_id, f'{1:064x}', 6)
+  writer.write(b'abc')
+  writer.write(b'def')
+  writer.verify(2)
+  writer.commit()
+
+  with storage.get_file_object(vault_id, f'{1:064x}') as f:
+    assert f.read() == b'abcdef'
+  assert tmp_files(vault_id) == []
+
+@pytest.mark.parametrize('pieces,data', [
+  (2, [b'abc']),
+  (1, [b'abc', b'def']),
+  (2, [b'abc', b'de']),
+])
+def test_writer_rejects_incomplete_blob(pieces, data):
+  vault_id = next(vault_ids)
+  writer = BlobWriter(vault_id, f'{2:064x}', 6)
+  for piece in data:
+    writer.write(piece)
+
+  with pytest.raises(ValueError):
+    writer.verify(pieces)
+
+  writer.abort()
+
+  assert tmp_files(vault_id) == []
+  assert not os.path.exists(storage.get_file_path(vault_id, f'{2:064x}'))
+
+def test_batcher_commits_concurrent_writers_together():
+  vault_id = next(vault_ids)
+  batcher = FsyncBatcher(0.01)
+
+  writers = []
+  for i in range(3):
+    writer = BlobWriter(vault_id, f'{i:064x}', 1)
+    writer.write(b'%d' % i)
+    writers.append(writer)
+
+  # a broken writer only fails its own commit
+  writers[1].file.close()
+
+  async def main():
+    return await asyncio.gather(*map(batcher.commit, writers), return_exceptions=True)
+
+  results = asyncio.run(main())
+
+  assert results[0] is None and results[2] is None
+  assert isinstance(results[1], ValueError)
+  assert batcher.stats() == {'batches': 1, 'commits': 3}
+
+  assert os.path.exists(storage.get_file_path(vault_id, f'{0:064x}'))
+  assert not os.path.exists(storage.get_file_path(vault_id, f'{1:064x}'))
+  assert os.path.exists(storage.get_file_path(vault_id, f'{2:064x}'))
+
+  writers[1].abort()
+  assert tmp_files(vault_id) == []
+
+def test_batcher_fails_whole_batch_when_directory_sync_fails(monkeypatch):
+  vault_id = next(vault_ids)
+  batcher = FsyncBatcher(0.01)
+
+  def fsync_dir(path: str):
+    raise OSError('fsync failed')
+
+  monkeypatch.setattr(storage, '_fsync_dir', fsync_dir)
+
+  writers = []
+  for i in range(2):
+    writer = BlobWriter(vault_id, f'{i:064x}', 1)
+    writer.write(b'x')
+    writers.append(writer)
+
+  async def main():
+    return await asyncio.gather(*map(batcher.commit, writers), return_exceptions=True)
+
+  results = asyncio.run(main())
+
+  assert all(isinstance(result, OSError) for result in results)
+
+def test_cleanup_removes_stale_tmp_files():
+  vault_id = next(vault_ids)
+  stale = BlobWriter(vault_id, f'{1:064x}', 1)
+  fresh = BlobWriter(vault_id, f'{2:064x}', 1)
+  stale.file.close()
+  fresh.file.close()
+
+  expired = time.time() - storage.TMP_MAX_AGE - 60
+  os.utime(stale.tmp_path, (expired, expired))
+
+  storage.cleanup_tmp_files()
+
+  assert not os.path.exists(stale.tmp_path)
+  assert os.path.exists(fresh.tmp_path)
+
+  fresh.abort()
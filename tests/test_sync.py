@@ -0,0 +1,220 @@
+import asyncio
+import base64
+import json
+import os
+import time
+import zlib
+from contextlib import ExitStack
+
+from src import storage
+from src.cache import blob_cache
+from src.config import settings
+from src.routers import sync
+from src.routers.sync import CHUNK_SIZE
+from sync_client import delete, init, push
+
+def test_push_pull(client, user, vault_id):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    record = push(ws, 'a.md', b'hello', 'hash-a')
+
+    ws.send_json({'op': 'pull', 'uid': record['uid']})
+    assert ws.receive_json() == {'size': 5, 'pieces': 1, 'deleted': False}
+    assert ws.receive_bytes() == b'hello'
+
+def test_catchup_latest_per_path(client, user, vault_id):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    push(ws, 'a.md', b'one', 'hash-a1', mtime=1)
+    latest = push(ws, 'a.md', b'two', 'hash-a2', mtime=2)
+    other = push(ws, 'b.md', b'three', 'hash-b')
+    push(ws, 'c.md', b'four', 'hash-c')
+    deleted = delete(ws, 'c.md', mtime=2)
+
+  with client.websocket_connect('/sync') as ws:
+    records = init(ws, user['token'], vault_id, 'd2')
+    assert sorted(r['uid'] for r in records) == [latest['uid'], other['uid']]
+
+    ws.send_json({'op': 'deleted'})
+    items = ws.receive_json()['items']
+    assert [item['path'] for item in items] == ['c.md']
+
+  with client.websocket_connect('/sync') as ws:
+    records = init(ws, user['token'], vault_id, 'd3', version=other['uid'], initial=False)
+    assert [r['uid'] for r in records] == [deleted['uid']]
+
+def test_idle_connections_do_not_hold_pool(client, engine, user, vault_id):
+  count = 300
+  assert count > settings.database.pool_size + settings.database.max_overflow
+  # the PostgreSQL invalidation listener holds one for good
+  held = engine.pool.checkedout()
+
+  with ExitStack() as stack:
+    conns = []
+    for i in range(count):
+      ws = stack.enter_context(client.websocket_connect('/sync'))
+      init(ws, user['token'], vault_id, f'idle{i}')
+      conns.append(ws)
+
+    # sessions are only taken per operation
+    assert engine.pool.checkedout() == held
+
+    with client.websocket_connect('/sync') as ws:
+      init(ws, user['token'], vault_id, 'writer')
+      record = push(ws, 'a.md', b'hello', 'hash-idle')
+
+    for ws in conns:
+      assert ws.receive_json()['uid'] == record['uid']
+
+      ws.send_json({'op': 'ping'})
+      assert ws.receive_json() == {'op': 'pong'}
+
+    assert engine.pool.checkedout() == held
+
+def test_failed_control_op_is_answered(client, user, vault_id):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1', features=['concurrent'])
+
+    # no path
+    ws.send_json({'op': 'history', 'rid': 1})
+    ws.send_json({'op': 'ping', 'rid': 2})
+
+    replies = {msg['rid']: msg for msg in (ws.receive_json(), ws.receive_json())}
+    assert replies[1]['res'] == 'err'
+    assert replies[2] == {'op': 'pong', 'rid': 2}
+
+def test_control_ops_are_bounded(client, user, vault_id, monkeypatch):
+  running = 0
+  peak = 0
+
+  async def get_size(self):
+    nonlocal running, peak
+    running += 1
+    peak = max(peak, running)
+    await asyncio.sleep(0.02)
+    running -= 1
+    await self.result()
+
+  monkeypatch.setattr(sync.UserSyncConn, 'get_size', get_size)
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1', features=['concurrent'])
+
+    for rid in range(20):
+      ws.send_json({'op': 'size', 'rid': rid})
+
+    rids = {ws.receive_json()['rid'] for _ in range(20)}
+    assert rids == set(range(20))
+
+  assert peak == settings.transfer.control_ops
+
+def test_deflated_catchup(client, user, vault_id):
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    pushed = [push(ws, f'notes/{i}.md', b'', f'{i:064x}') for i in range(20)]
+
+  with client.websocket_connect('/sync') as ws:
+    records = init(ws, user['token'], vault_id, 'd2', features=['deflate'])
+
+  # catch-up records are small, but still compressed
+  assert records and all(msg['op'] == 'z' for msg in records)
+
+  inflater = zlib.decompressobj(-settings.transfer.compress_window)
+  records = [json.loads(inflater.decompress(base64.b64decode(msg['data']))) for msg in records]
+  assert [msg['uid'] for msg in records] == [msg['uid'] for msg in pushed]
+
+def test_pull_from_blob_cache(client, user, vault_id, monkeypatch):
+  monkeypatch.setattr(blob_cache, 'max_size', 4 * CHUNK_SIZE)
+  data = os.urandom(CHUNK_SIZE + 100)
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1')
+    record = push(ws, 'cached.bin', data, f'{len(data):064x}')
+
+    # served from memory, the file is not read
+    path = storage.get_file_path(vault_id, record['hash'])
+    os.rename(path, path + '.moved')
+    hits = blob_cache.hits
+
+    ws.send_json({'op': 'pull', 'uid': record['uid']})
+    assert ws.receive_json() == {'size': len(data), 'pieces': 2, 'deleted': False}
+    assert bytes(ws.receive_bytes()) + bytes(ws.receive_bytes()) == data
+    assert blob_cache.hits == hits + 1
+
+def test_inline_push(client, user, vault_id, monkeypatch):
+  reads = []
+  read_blob = sync.UserVaultChannel._read_blob
+
+  def counting_read_blob(self, hash):
+    reads.append(hash)
+    return read_blob(self, hash)
+
+  monkeypatch.setattr(sync.UserVaultChannel, '_read_blob', counting_read_blob)
+  hash = f'{0x1771:064x}'
+
+  with client.websocket_connect('/sync') as ws:
+    init(ws, user['token'], vault_id, 'd1', features=['inline'])
+
+    # no one else to send the content to
+    notify = push(ws, 'a.md', b'inline', hash)
+    assert 'data' not in notify
+
+    with client.websocket_connect('/sync') as other:
+      init(other, user['token'], vault_id, 'd2', features=['inline'])
+
+      push(ws, 'b.md', b'inline', hash)
+      assert base64.b64decode(other.receive_json()['data']) == b'inline'
+      # the blob was cached by its upload
+      assert reads == []
+
+      blob_cache.discard(vault_id, hash)
+      push(ws, 'c.md', b'inline', hash)
+      assert base64.b64decode(other.receive_json()['data']) == b'inline'
+      assert reads == [hash]
+
+def test_concurrent_upload_of_same_blob_is_skipped(client, user, vault_id):
+  data = os.urandom(CHUNK_SIZE + 100)
+  hash = f'{0x4500:064x}'
+  msg = {
+    'op': 'push',
+    'hash': hash,
+    'folder': False,
+    'deleted': False,
+    'size': len(data),
+    'pieces': 2,
+    'ctime': 1,
+    'mtime': 1,
+  }
+
+  with client.websocket_connect('/sync') as ws, client.websocket_connect('/sync') as other:
+    init(ws, user['token'], vault_id, 'd1')
+    init(other, user['token'], vault_id, 'd2')
+    waits = sync.upload_stats['waits']
+    skipped = sync.upload_stats['skipped']
+
+    ws.send_json(dict(msg, path='a.bin'))
+    assert ws.receive_json() == {'res': 'missing-blobs'}
+    ws.send_bytes(data[:CHUNK_SIZE])
+    assert ws.receive_json() == {'res': 'missing-blobs'}
+
+    # the same content from another device waits for the first upload
+    other.send_json(dict(msg, path='b.bin'))
+    deadline = time.monotonic() + 5
+    while sync.upload_stats['waits'] == waits:
+      assert time.monotonic() < deadline
+      time.sleep(0.01)
+
+    ws.send_bytes(data[CHUNK_SIZE:])
+    first = ws.receive_json()
+    assert first['path'] == 'a.bin'
+    assert ws.receive_json() == {'res': 'ok'}
+
+    # and commits its record without being asked for the blob
+    replies = [other.receive_json() for _ in range(3)]
+    assert [reply.get('path') for reply in replies] == ['a.bin', 'b.bin', None]
+    assert replies[-1] == {'res': 'ok'}
+    assert sync.upload_stats['skipped'] == skipped + 1
+
+    other.send_json({'op': 'pull', 'uid': replies[1]['uid']})
+    assert other.receive_json() == {'size': len(data), 'pieces': 2, 'deleted': False}
+    assert bytes(other.receive_bytes()) + bytes(other.receive_bytes()) == data
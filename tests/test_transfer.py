@@ -0,0 +1,148 @@
+import asyncio
+from types import SimpleNamespace
+
+from src import transfer
+from src.transfer import BufferPool, TokenBucket, TransferScheduler
+
+def test_reserve_counts_against_budget_without_allocating():
+  pool = BufferPool(1024, 2, idle=2)
+
+  async def main():
+    async with pool.reserve(), pool.reserve():
+      assert pool.stats()['in_use'] == 2
+
+      # the budget is spent by the reservations
+      waiter = asyncio.create_task(pool.get())
+      await asyncio.sleep(0.01)
+      assert not waiter.done()
+      assert pool.stats()['waiting'] == 1
+
+    buffer = await waiter
+    pool.put(buffer)
+
+  asyncio.run(main())
+
+  assert pool.stats()['allocated'] == 1
+  assert pool.stats()['in_use'] == 0
+
+def test_idle_buffers_are_released():
+  pool = BufferPool(1024, 8, idle=2)
+
+  async def main():
+    buffers = [await pool.get() for _ in range(6)]
+    assert pool.stats()['allocated'] == 6
+
+    for buffer in buffers:
+      pool.put(buffer)
+
+  asyncio.run(main())
+
+  assert pool.stats()['allocated'] == 2
+  assert len(pool._free) == 2
+
+async def settle():
+  # let woken tasks run up to their next wait
+  for _ in range(5):
+    await asyncio.sleep(0)
+
+def test_small_transfers_are_admitted_ahead_of_large_ones():
+  scheduler = TransferScheduler(1, small_size=100, small_slots=1, conn_rate=0, user_rate=0)
+  admitted = []
+
+  async def run(name: str, size: int, release: asyncio.Event):
+    async with scheduler.slot(size):
+      admitted.append(name)
+      await release.wait()
+
+  async def main():
+    events = {name: asyncio.Event() for name in 'abcd'}
+    tasks = []
+    for name, size in [('a', 1000), ('b', 1000), ('c', 10), ('d', 10)]:
+      tasks.append(asyncio.create_task(run(name, size, events[name])))
+      await asyncio.sleep(0)
+
+    # the small one takes the extra slot, the next small one waits
+    # in front of the large one queued before it
+    assert admitted == ['a', 'c']
+    assert scheduler.stats()['queued'] == 2
+
+    events['a'].set()
+    await settle()
+    assert admitted == ['a', 'c', 'd']
+
+    # large transfers only use the regular slots
+    events['c'].set()
+    await settle()
+    assert admitted == ['a', 'c', 'd']
+
+    events['d'].set()
+    events['b'].set()
+    await asyncio.gather(*tasks)
+
+  asyncio.run(main())
+
+  assert admitted == ['a', 'c', 'd', 'b']
+  assert scheduler.stats()['active'] == 0
+
+def test_cancelled_waiter_gives_up_its_place():
+  scheduler = TransferScheduler(1, small_size=100, small_slots=0, conn_rate=0, user_rate=0)
+
+  async def main():
+    async with scheduler.slot(1000):
+      waiter = asyncio.create_task(scheduler.slot(1000).__aenter__())
+      await asyncio.sleep(0)
+      waiter.cancel()
+      await asyncio.sleep(0)
+
+    assert scheduler.stats()['active'] == 0
+    assert scheduler.stats()['queued'] == 0
+
+    async with scheduler.slot(1000) as wait:
+      assert wait < 0.1
+
+  asyncio.run(main())
+
+def test_token_bucket_limits_the_rate(monkeypatch):
+  now = [0.0]
+  sleeps = []
+
+  async def sleep(delay: float):
+    sleeps.append(delay)
+    now[0] += delay
+
+  monkeypatch.setattr(transfer, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+  monkeypatch.setattr(transfer, 'asyncio', SimpleNamespace(sleep=sleep))
+
+  bucket = TokenBucket(1000, 1000)
+
+  async def main():
+    # the burst passes at once, the rest at the rate
+    await bucket.consume(1000)
+    assert sleeps == []
+
+    await bucket.consume(500)
+    assert sleeps == [0.5]
+
+    # pieces larger than the burst go into debt
+    await bucket.consume(2000)
+    assert sleeps == [0.5, 2.0]
+
+    now[0] += 10
+    await bucket.consume(1000)
+    assert sleeps == [0.5, 2.0]
+
+  asyncio.run(main())
+
+  unlimited = TokenBucket(0, 0)
+  asyncio.run(unlimited.consume(10 ** 9))
+  assert len(sleeps) == 2
+
+def test_user_bucket_is_shared_between_connections():
+  scheduler = TransferScheduler(1, small_size=100, small_slots=0, conn_rate=100, user_rate=1000)
+
+  conn, user = scheduler.buckets(1)
+  other_conn, other_user = scheduler.buckets(1)
+
+  assert user is other_user
+  assert conn is not other_conn
+  assert scheduler.buckets(2)[1] is not user
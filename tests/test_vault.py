@@ -0,0 +1,13 @@
+def test_share_remove(client, make_user, user, vault_id):
+  guest = make_user()
+  client.post('/vault/share/invite', json={'vault_uid': vault_id, 'email': guest['email'], 'token': user['token']})
+
+  res = client.post('/vault/share/remove', json={'vault_uid': vault_id, 'share_uid': 'guest', 'token': user['token']})
+  # errors are reported in the body
+  assert res.json()['status_code'] == 400
+
+  res = client.post('/vault/share/remove', json={'vault_uid': vault_id, 'share_uid': str(guest['id']), 'token': user['token']})
+  assert res.json() == {}
+
+  shares = client.post('/vault/share/list', json={'vault_uid': vault_id, 'token': user['token']}).json()['shares']
+  assert shares == []